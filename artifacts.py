@@ -0,0 +1,160 @@
+'''
+Content addressed cache of knife outputs.
+An entry is keyed by the sha256 of the input file content and the knife
+parameters, and holds the bounds, jackknife map and, if asked for, the
+labels as .npy files with a meta.json. Entries live in the disk cache
+(cache.CACHE_DIR), the least recently used ones are removed over the size
+limit.
+'''
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+from . import cache
+from . import utils
+from . import instrument
+
+
+# set with environment variable COSMOKNIFE_ARTIFACT_SIZE, bytes
+SIZE_LIMIT = int(os.environ.get('COSMOKNIFE_ARTIFACT_SIZE', cache.CACHE_SIZE))
+HASH_LIMIT = 64 * 10000  # hashes of about 10000 files, bytes
+
+
+def get_hash_fn(fn):
+    '''File keeping the hash of file fn, for its path, size and time.'''
+    st = os.stat(fn)
+    stamp = '{0}:{1:d}:{2:d}'.format(os.path.abspath(fn), st.st_size,
+                                     st.st_mtime_ns)
+    return os.path.join(cache.get_cache_dir('hashes'),
+                        hashlib.sha256(stamp.encode()).hexdigest())
+
+
+def file_hash(fn, blocksize=1 << 24):
+    '''sha256 of the content of file fn. Kept in the cache for the path,
+       size and modification time, so unchanged files are read once; the
+       least recently used hashes are removed over HASH_LIMIT.'''
+    fn_h = get_hash_fn(fn)
+    if os.path.exists(fn_h):
+        cache.touch(fn_h)
+        with open(fn_h) as f:
+            return f.read().strip()
+
+    instrument.log('>> Hashing file: {}'.format(fn))
+    h = hashlib.sha256()
+    with instrument.span('hash', npts=os.path.getsize(fn)), \
+            open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    cache.evict(os.path.dirname(fn_h), HASH_LIMIT, size_new=len(h.hexdigest()))
+    with open(fn_h, 'w') as f:
+        f.write(h.hexdigest())
+
+    return h.hexdigest()
+
+
+def get_key(kind, fn, **params):
+    '''Key of the entry of kind, e.g. 'knife_rand', for file fn and the
+       parameters, also the meta data of the entry.'''
+    meta = {'kind': kind, 'source': os.path.abspath(fn),
+            'sha256': file_hash(fn),
+            'params': {k: v.item() if isinstance(v, np.generic) else v
+                       for k, v in sorted(params.items())}}
+    key = hashlib.sha256(json.dumps([kind, meta['sha256'], meta['params']],
+                                    sort_keys=True).encode()).hexdigest()
+
+    return key, meta
+
+
+def get_dir():
+    '''Directory of the entries.'''
+    return cache.get_cache_dir('artifacts')
+
+
+def load(key):
+    '''Arrays of the entry key, None if not in the cache.'''
+    path = os.path.join(get_dir(), key)
+    if not os.path.isdir(path):
+        return None
+    cache.touch(path)
+    instrument.log('>> Loading knife outputs from cache: {}'.format(path))
+    arrays = {fn[:-len('.npy')]: np.load(os.path.join(path, fn))
+              for fn in os.listdir(path) if fn.endswith('.npy')}
+    with open(os.path.join(path, 'meta.json')) as f:
+        arrays['meta'] = json.load(f)
+
+    return arrays
+
+
+def store(key, meta, arrays):
+    '''Store the arrays (dict, None values skipped) in the entry key.'''
+    arrays = {k: np.asarray(v) for k, v in arrays.items() if v is not None}
+    size = sum(v.nbytes for v in arrays.values())
+    if size > SIZE_LIMIT:
+        return
+    cache_dir = get_dir()
+    cache.evict(cache_dir, SIZE_LIMIT, size_new=size)
+
+    tmp = os.path.join(cache_dir, '.{0}.{1:d}'.format(key, os.getpid()))
+    os.makedirs(tmp, exist_ok=True)
+    for k, v in arrays.items():
+        np.save(os.path.join(tmp, k + '.npy'), v)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    path = os.path.join(cache_dir, key)
+    try:
+        os.rename(tmp, path)  # other processes only see complete entries
+    except OSError:  # stored meanwhile by another process
+        shutil.rmtree(tmp, ignore_errors=True)
+    instrument.log(':: Knife outputs cached: {}'.format(path))
+
+
+def pack_map(jk_map):
+    '''Arrays of a full sky or sparse jackknife map, for store.'''
+    if isinstance(jk_map, utils.SparseMap):
+        return {'map_ipix': jk_map.ipix, 'map_jkl': jk_map.jkl,
+                'map_nside': np.array(jk_map.nside)}
+    return {'jk_map': jk_map}
+
+
+def unpack_map(arrays):
+    '''Jackknife map from the arrays of pack_map, None if not there.'''
+    if 'map_ipix' in arrays:
+        return utils.SparseMap(int(arrays['map_nside']), arrays['map_ipix'],
+                               arrays['map_jkl'])
+    return arrays.get('jk_map')
+
+
+def list_artifacts():
+    '''Meta data of the entries, least recently used first.'''
+    metas = []
+    for path in cache.list_entries(get_dir()):
+        with open(os.path.join(path, 'meta.json')) as f:
+            metas.append(dict(json.load(f), key=os.path.basename(path),
+                              size=cache.get_size(path)))
+
+    return metas
+
+
+def invalidate(fn=None, key=None):
+    '''Remove the entries of input file fn (path or content), the entry
+       key, or all the entries if neither is given. The kept hashes of fn,
+       or of all the files, are removed too.
+       Return the number of entries removed.'''
+    sha = None
+    if fn is not None and os.path.exists(fn):
+        sha = file_hash(fn)
+        cache.remove(get_hash_fn(fn))
+    elif fn is None and key is None:
+        for path in cache.list_entries(cache.get_cache_dir('hashes')):
+            cache.remove(path)
+    n = 0
+    for meta in list_artifacts():
+        if (key is None and fn is None) or meta['key'] == key or \
+                (fn is not None and (meta['sha256'] == sha or
+                                     meta['source'] == os.path.abspath(fn))):
+            cache.remove(os.path.join(get_dir(), meta['key']))
+            n += 1
+    instrument.log('-- Cache: {0:d} knife outputs removed'.format(n))
+
+    return n
@@ -0,0 +1,285 @@
+'''
+Benchmarks of the pipeline stages on synthetic footprints and randoms.
+Each case (stage, npts, nside, njr) runs in a fresh process, the wall time,
+peak RSS, peak traced allocations and throughput of the stage are appended
+to a JSON lines file, one record per case, e.g.
+    python -m <package>.bench -n 1e5 1e7 --nside 256 1024 -o b.jsonl
+Two result files are compared with compare, and check_import_time
+(--import-time) checks that the core modules import fast, without pandas,
+healpy or matplotlib.
+'''
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import argparse
+import tracemalloc
+import subprocess
+import contextlib
+import collections
+import numpy as np
+import multiprocessing as mp
+from . import instrument
+
+
+STAGES = ['knife', 'label_bounds', 'label_map', 'jk_masks', 'merge_maps']
+CORE = ['kernel', 'knife', 'label', 'kmask', 'catio', 'utils', 'cli']
+HEAVY = ['pandas', 'healpy', 'matplotlib', 'astropy', 'scipy']
+
+# box in RA, DEC [degree], RA from ra_min to ra_max may cross 0,
+# holes: (n, 3) array of [ra, dec, radius]
+Footprint = collections.namedtuple('Footprint', ['ra_min', 'ra_max',
+                                                 'dec_min', 'dec_max',
+                                                 'holes'])
+
+
+#--- Synthetic data ---#
+
+
+def make_footprint(ra_min=310., ra_max=60., dec_min=-10., dec_max=40.,
+                   nholes=20, r_hole=(0.5, 3.), seed=0):
+    '''Footprint crossing RA=0 by default, with nholes circular holes of
+       radii in r_hole [degree], e.g. bright stars masked.'''
+    rng = np.random.default_rng(seed)
+    width = (ra_max - ra_min) % 360.
+    holes = np.column_stack((
+        (ra_min + rng.uniform(0., width, nholes)) % 360.,
+        rng.uniform(dec_min, dec_max, nholes),
+        rng.uniform(r_hole[0], r_hole[1], nholes)))
+
+    return Footprint(ra_min, ra_max, dec_min, dec_max, holes)
+
+
+def in_footprint(fp, ra, dec):
+    '''Check if the points RA, DEC [degree] are in the footprint.'''
+    res = ((ra - fp.ra_min) % 360. <= (fp.ra_max - fp.ra_min) % 360.) & \
+        (fp.dec_min <= dec) & (dec <= fp.dec_max)
+    if len(fp.holes) == 0:
+        return res
+
+    from . import coords
+    vec = coords.radec2vec(ra, dec).T
+    centers = coords.radec2vec(fp.holes[:, 0], fp.holes[:, 1]).T
+    cos_r = np.cos(np.deg2rad(fp.holes[:, 2]))
+    for c, cr in zip(centers, cos_r):
+        res &= vec @ c < cr
+
+    return res
+
+
+def make_randoms(fp, npts, seed=0, chunksize=10000000):
+    '''Uniform randoms [ra, dec, redshift, weight] in the footprint.'''
+    rng = np.random.default_rng(seed)
+    width = (fp.ra_max - fp.ra_min) % 360.
+    sin_dec = np.sin(np.deg2rad([fp.dec_min, fp.dec_max]))
+    rand = np.empty((npts, 4))
+    n = 0
+    while n < npts:
+        m = min(chunksize, 2 * (npts - n) + 1000)
+        ra = (fp.ra_min + rng.uniform(0., width, m)) % 360.
+        dec = np.rad2deg(np.arcsin(rng.uniform(sin_dec[0], sin_dec[1], m)))
+        keep = np.flatnonzero(in_footprint(fp, ra, dec))[:npts - n]
+        k = len(keep)
+        rand[n:n+k, 0], rand[n:n+k, 1] = ra[keep], dec[keep]
+        rand[n:n+k, 2] = rng.uniform(0., 1., k)  # redshift
+        rand[n:n+k, 3] = rng.uniform(0.5, 1., k)  # weight
+        n += k
+
+    return rand
+
+
+def make_mask(fp, nside):
+    '''Healpix mask (galactic) of the footprint, 1 inside and 0 outside.'''
+    from . import coords
+    radec = coords.get_pix_radec(nside)
+    return in_footprint(fp, radec[0], radec[1]).astype(np.float64)
+
+
+#--- Stages ---#
+
+
+def setup_case(stage, npts, nside, njr, seed=0, workdir=None):
+    '''Inputs of the stage, not timed, output files go to workdir.
+       Return the stage function and the number of items it processes.'''
+    from . import kernel, label, kmask, utils
+    fp = make_footprint(seed=seed)
+    rand = make_randoms(fp, npts, seed=seed)
+    data = rand[:, [0, 1, 3]]
+    nra = max(int(round(np.sqrt(njr))), 1)
+    rra = 360. - fp.ra_min
+
+    if stage == 'knife':
+        def run():
+            regions = kernel.knife(data, njr, nra, rra)
+            kernel.make_jk_bounds(data, regions, rra)
+        return run, npts
+
+    regions = kernel.knife(data, njr, nra, rra)
+    bounds = kernel.make_jk_bounds(data, regions, rra)
+    cat = make_randoms(fp, npts, seed=seed + 1)
+    if stage == 'label_bounds':
+        return lambda: label.label_w_bounds(cat, bounds), npts
+    elif stage == 'label_map':
+        jk_map = kernel.make_jk_map(data, regions, nside)
+        return lambda: label.label_w_map(cat, jk_map), npts
+    elif stage == 'jk_masks':
+        mask = make_mask(fp, nside)
+        froot = os.path.join(workdir or tempfile.gettempdir(), 'bench')
+        return lambda: kmask.jk_masks_w_bounds(mask, bounds, froot,
+                                               test=False), len(mask)
+    elif stage == 'merge_maps':
+        jk_map = kernel.make_jk_map(data, regions, nside)
+        return lambda: utils.merge_jk_maps([jk_map, jk_map]), 2 * len(jk_map)
+    else:
+        raise ValueError('Wrong stage: {}'.format(stage))
+
+
+def run_case(stage, npts, nside, njr, seed=0):
+    '''Run one case, in a fresh process. Return its record.'''
+    with open(os.devnull, 'w') as f, contextlib.redirect_stdout(f), \
+            tempfile.TemporaryDirectory() as workdir:
+        func, nitems = setup_case(stage, npts, nside, njr, seed=seed,
+                                  workdir=workdir)
+        rss0 = instrument.get_peak_rss()
+        tracemalloc.start()
+        t0 = time.perf_counter()
+        func()
+        wall = time.perf_counter() - t0
+        alloc = tracemalloc.get_traced_memory()[1] / 1024.**2
+        tracemalloc.stop()
+
+    return {'stage': stage, 'npts': npts, 'nside': nside, 'njr': njr,
+            'wall': wall, 'throughput': nitems / wall,
+            'peak_rss_mb': instrument.get_peak_rss(), 'setup_rss_mb': rss0,
+            'peak_alloc_mb': alloc}
+
+
+def get_version():
+    '''Git commit of the code, None if unknown.'''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_grid(fo, stages=STAGES, sizes=(100000, 1000000), nsides=(256,),
+             njrs=(100,), seed=0):
+    '''Run all the cases of the grid, append the records to fo (JSON lines).
+       knife and label_bounds do not depend on nside, jk_masks and
+       merge_maps do not depend on npts, except for making the inputs.'''
+    meta = {'version': get_version(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'host': platform.node(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    ctx = mp.get_context('spawn')  # fresh process, for the peak RSS
+    records = []
+    for stage in stages:
+        for npts in sizes:
+            for nside in nsides:
+                for njr in njrs:
+                    with ctx.Pool(1) as pool:
+                        rec = pool.apply(run_case,
+                                         (stage, int(npts), nside, njr, seed))
+                    rec.update(meta)
+                    records.append(rec)
+                    print('-- {stage}: npts = {npts:d}, nside = {nside:d}, '
+                          'njr = {njr:d}: {wall:.3f} s, {throughput:.3e} /s, '
+                          'peak RSS {peak_rss_mb:.1f} MB'.format(**rec))
+                    with open(fo, 'a') as f:
+                        f.write(json.dumps(rec) + '\n')
+    print(':: Benchmark results written to file: {}'.format(fo))
+
+    return records
+
+
+def check_import_time(budget=0.5, modules=CORE, repeat=3):
+    '''Time to import the core modules in a fresh interpreter, best of
+       repeat, and the heavy modules imported with them, should be none.
+       Return the time, the heavy modules and if within budget [s].'''
+    pkg = __package__ or os.path.basename(os.path.dirname(
+        os.path.abspath(__file__)))
+    code = ('import sys, time, json; t = time.perf_counter(); '
+            'import {0}; t = time.perf_counter() - t; '
+            'print(json.dumps([t, [m for m in {1!r} if m in sys.modules]]))'
+            ).format(', '.join(pkg + '.' + m for m in modules), HEAVY)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] +
+        [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], env=env,
+                             capture_output=True, text=True, check=True)
+        t, heavy = json.loads(out.stdout)
+        times.append(t)
+    ok = min(times) <= budget and not heavy
+    print('-- Import time of the core modules: {0:.3f} s, budget {1:.3f} s, '
+          'heavy modules: {2}'.format(min(times), budget,
+                                      ', '.join(heavy) or 'none'))
+
+    return min(times), heavy, ok
+
+
+def load_results(fn):
+    '''Records of a result file.'''
+    with open(fn) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(fn_old, fn_new, tol=0.2):
+    '''Compare the wall time of the cases in two result files, the last
+       record of each case counts. Return the cases slower by more than tol.'''
+    def key(rec):
+        return rec['stage'], rec['npts'], rec['nside'], rec['njr']
+
+    old = {key(r): r for r in load_results(fn_old)}
+    slower = []
+    for rec in load_results(fn_new):
+        if key(rec) not in old:
+            continue
+        ratio = rec['wall'] / old[key(rec)]['wall']
+        print('-- {0}: npts = {1:d}, nside = {2:d}, njr = {3:d}: '
+              'time ratio {4:.3f}'.format(*key(rec), ratio))
+        if ratio > 1. + tol:
+            slower.append((key(rec), ratio))
+
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the stages.')
+    parser.add_argument('-o', '--output', default='bench.jsonl',
+                        help='result file, JSON lines, appended')
+    parser.add_argument('-s', '--stages', nargs='+', default=STAGES,
+                        choices=STAGES)
+    parser.add_argument('-n', '--npts', nargs='+', type=float,
+                        default=[1e5, 1e6])
+    parser.add_argument('--nside', nargs='+', type=int, default=[256])
+    parser.add_argument('--njr', nargs='+', type=int, default=[100])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compare', metavar='OLD',
+                        help='compare the output file with this one only')
+    parser.add_argument('--import-time', metavar='BUDGET', type=float,
+                        help='only check the import time of the core '
+                             'modules against the budget [s]')
+    args = parser.parse_args(argv)
+
+    if args.import_time is not None:
+        return 0 if check_import_time(budget=args.import_time)[2] else 1
+
+    if args.compare is not None:
+        slower = compare(args.compare, args.output)
+        print('-- {0:d} cases slower'.format(len(slower)))
+        return 1 if slower else 0
+
+    run_grid(args.output, stages=args.stages,
+             sizes=[int(n) for n in args.npts], nsides=args.nside,
+             njrs=args.njr, seed=args.seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+'''
+Disk cache for results reused between runs.
+Entries are files or directories under the cache directory, the least
+recently used ones are removed when the cache grows over its size limit.
+'''
+import os
+import shutil
+from . import instrument
+
+
+# set with environment variables COSMOKNIFE_CACHE, COSMOKNIFE_CACHE_SIZE
+CACHE_DIR = os.environ.get(
+    'COSMOKNIFE_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'cosmoknife'))
+CACHE_SIZE = int(os.environ.get('COSMOKNIFE_CACHE_SIZE', 8 * 1024**3))  # bytes
+
+
+def get_cache_dir(name):
+    '''Directory of the cache name, created if needed.'''
+    path = os.path.join(CACHE_DIR, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def get_size(path):
+    '''Size of file or directory in bytes.'''
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    size = 0
+    for root, _, fns in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, fn)) for fn in fns)
+    return size
+
+
+def touch(path):
+    '''Mark the entry as just used.'''
+    os.utime(path)
+
+
+def remove(path):
+    '''Remove an entry.'''
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def list_entries(cache_dir):
+    '''Entries in the cache directory, least recently used first.'''
+    entries = [os.path.join(cache_dir, fn) for fn in os.listdir(cache_dir)
+               if not fn.startswith('.')]  # skip temporary files
+    return sorted(entries, key=os.path.getmtime)
+
+
+def evict(cache_dir, size_limit, size_new=0):
+    '''Remove the least recently used entries, until the entries left plus
+       a new entry of size size_new fit in size_limit bytes.'''
+    entries = list_entries(cache_dir)
+    sizes = [get_size(p) for p in entries]
+    total = sum(sizes) + size_new
+    for p, size in zip(entries, sizes):
+        if total <= size_limit:
+            break
+        instrument.log('-- Cache: removing {}'.format(p))
+        remove(p)
+        total -= size
@@ -0,0 +1,293 @@
+'''
+Catalog I/O, text and binary columnar formats.
+Binary files: .npy (2D array), .fits (binary table) and .h5/.hdf5 (one
+dataset per column), read with memory mapping where possible.
+'''
+import os
+import queue
+import threading
+import contextlib
+import numpy as np
+from . import utils
+from . import instrument
+
+
+# default column names, also the order of the columns in .npy files
+COLUMNS = ['RA', 'DEC', 'redshift', 'weight', 'jackknife']
+KNIFE_COLUMNS = [0, 1, 3]  # RA, DEC, weight
+CHUNKSIZE = 1 << 22  # rows of a column copied at a time
+
+
+def get_fmt(fn):
+    '''File format from the file name.'''
+    fn = fn.lower()
+    if fn.endswith('.npy'):
+        return 'npy'
+    elif fn.endswith(('.fits', '.fit', '.fits.gz')):
+        return 'fits'
+    elif fn.endswith(('.h5', '.hdf5')):
+        return 'hdf5'
+    else:
+        return 'txt'
+
+
+def get_names(names, cols):
+    '''Names of the columns cols, given by name or position.'''
+    if cols is None:
+        return list(names)
+    return [names[c] if isinstance(c, (int, np.integer)) else c for c in cols]
+
+
+#--- Readers, context managers giving (names, columns) ---#
+
+
+def jkl_fn_npy(fn):
+    '''File of the jackknife column added to .npy file.'''
+    return fn[:-len('.npy')] + '_jackknife.npy'
+
+
+@contextlib.contextmanager
+def open_npy(fn):
+    '''Open .npy file, memory mapped.'''
+    arr = np.load(fn, mmap_mode='r')
+    names = COLUMNS[:arr.shape[1]]
+    columns = {n: arr[:, i] for i, n in enumerate(names)}
+    if 'jackknife' not in columns and os.path.exists(jkl_fn_npy(fn)):
+        names = names + ['jackknife']
+        columns['jackknife'] = np.load(jkl_fn_npy(fn), mmap_mode='r')
+    yield names, columns
+
+
+@contextlib.contextmanager
+def open_fits(fn):
+    '''Open fits binary table in the first extension, memory mapped.'''
+    from astropy.io import fits
+    with fits.open(fn, memmap=True) as hdul:
+        names = list(hdul[1].columns.names)
+        columns = {n: hdul[1].data[n] for n in names}
+        if 'jackknife' not in columns and 'JACKKNIFE' in hdul:
+            names.append('jackknife')
+            columns['jackknife'] = hdul['JACKKNIFE'].data['jackknife']
+        yield names, columns
+
+
+@contextlib.contextmanager
+def open_hdf5(fn):
+    '''Open hdf5 file, columns read on demand.'''
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('h5py is needed for hdf5 files')
+    with h5py.File(fn, 'r') as f:
+        if 'columns' in f.attrs:
+            names = [str(n) for n in f.attrs['columns']]
+        else:
+            names = [n for n in COLUMNS if n in f]
+        if 'jackknife' in f and 'jackknife' not in names:
+            names.append('jackknife')
+        yield names, {n: f[n] for n in names}
+
+
+READERS = {'npy': open_npy, 'fits': open_fits, 'hdf5': open_hdf5}
+
+
+def load_data(fn, cols=None, tp='', fmt=None, verbose=True,
+              dtype=np.float64):
+    '''Load data file, only the columns cols (names or positions).
+       tp='knife' selects RA, DEC, weight. dtype: type of the values,
+       np.float32 halves the memory, exact for float32 source columns.'''
+    fmt = get_fmt(fn) if fmt is None else fmt
+    if tp == 'knife':
+        cols = KNIFE_COLUMNS
+    if fmt == 'txt':
+        with instrument.span('load') as sp:
+            data = utils.load_data_pd(fn, verbose=verbose, dtype=dtype)
+            sp['npts'] = len(data)
+        return data if cols is None else data[:, cols]
+
+    if verbose:
+        instrument.log('>> Loading data: {}'.format(fn))
+    with instrument.span('load') as sp, READERS[fmt](fn) as (names, columns):
+        data = np.column_stack([np.asarray(columns[n][:], dtype=dtype)
+                                for n in get_names(names, cols)])
+        sp['npts'] = len(data)
+
+    return data
+
+
+def get_npts(fn, fmt=None):
+    '''Number of rows of binary file fn.'''
+    fmt = get_fmt(fn) if fmt is None else fmt
+    with READERS[fmt](fn) as (names, columns):
+        return len(columns[names[0]])
+
+
+def load_data_chunks(fn, chunksize, cols=None, tp='', fmt=None,
+                     verbose=True, dtype=np.float64):
+    '''Load data file in chunks of chunksize rows, one chunk at a time.
+       dtype: type of the values, see load_data.'''
+    fmt = get_fmt(fn) if fmt is None else fmt
+    if tp == 'knife':
+        cols = KNIFE_COLUMNS
+    if fmt == 'txt':
+        for data in utils.load_data_chunks(fn, chunksize, verbose=verbose,
+                                           dtype=dtype):
+            yield data if cols is None else data[:, cols]
+        return
+
+    if verbose:
+        instrument.log('>> Loading data in chunks of {0:d} rows: {1}'.format(
+            chunksize, fn))
+    with READERS[fmt](fn) as (names, columns):
+        names = get_names(names, cols)
+        npts = len(columns[names[0]])
+        for i0 in range(0, npts, chunksize):
+            i1 = min(i0 + chunksize, npts)
+            yield np.column_stack([np.asarray(columns[n][i0:i1], dtype=dtype)
+                                   for n in names])
+
+
+def prefetch(chunks, depth=1):
+    '''Read the next depth chunks in a thread while the current one is
+       used, e.g. prefetch(load_data_chunks(fn, chunksize)).'''
+    q = queue.Queue(maxsize=depth)
+    done = object()  # end of the chunks
+
+    def read():
+        try:
+            for chunk in chunks:
+                q.put(chunk)
+            q.put(done)
+        except BaseException as e:  # raised again in the caller
+            q.put(e)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        chunk = q.get()
+        if chunk is done:
+            return
+        if isinstance(chunk, BaseException):
+            raise chunk
+        yield chunk
+
+
+#--- Writers ---#
+
+
+def save_npy(data, fn, names):
+    '''Save data to .npy file.'''
+    np.save(fn, data)
+
+
+def save_fits(data, fn, names):
+    '''Save data to fits binary table.'''
+    from astropy.io import fits
+    cols = [fits.Column(name=n, format='J' if n == 'jackknife' else 'D',
+                        array=data[:, i]) for i, n in enumerate(names)]
+    fits.BinTableHDU.from_columns(cols).writeto(fn, overwrite=True)
+
+
+def save_hdf5(data, fn, names):
+    '''Save data to hdf5 file, one dataset per column.'''
+    import h5py
+    with h5py.File(fn, 'w') as f:
+        for i, n in enumerate(names):
+            f.create_dataset(n, data=data[:, i].astype(
+                np.int32 if n == 'jackknife' else np.float64))
+        f.attrs['columns'] = names
+
+
+WRITERS = {'npy': save_npy, 'fits': save_fits, 'hdf5': save_hdf5}
+
+
+def save_data(data, fn, names=None, fmt=None):
+    '''Save data to binary file, with column names (COLUMNS by default).'''
+    fmt = get_fmt(fn) if fmt is None else fmt
+    names = COLUMNS[:data.shape[1]] if names is None else names
+    with instrument.span('save', npts=len(data)):
+        WRITERS[fmt](data, fn, names)
+    instrument.log(':: Data written to file: {}'.format(fn))
+
+
+#--- Add jackknife column ---#
+
+
+def add_jkl_npy(fn, jkl):
+    '''Save the jackknife column next to .npy file.'''
+    np.save(jkl_fn_npy(fn), jkl)
+
+
+def add_jkl_fits(fn, jkl):
+    '''Add the jackknife column as a new extension of fits file.
+       The column is written CHUNKSIZE rows at a time.'''
+    from astropy.io import fits
+    with fits.open(fn, mode='update', memmap=True) as hdul:
+        if 'JACKKNIFE' in hdul:
+            col = hdul['JACKKNIFE'].data['jackknife']
+            for i0 in range(0, len(jkl), CHUNKSIZE):
+                col[i0:i0+CHUNKSIZE] = jkl[i0:i0+CHUNKSIZE]
+            return
+    # header of the extension, then the rows appended as big endian int32
+    col = fits.Column(name='jackknife', format='J',
+                      array=np.zeros(0, dtype=np.int32))
+    header = fits.BinTableHDU.from_columns([col], name='JACKKNIFE').header
+    header['NAXIS2'] = len(jkl)
+    with open(fn, 'ab') as f:
+        f.write(header.tostring().encode('ascii'))
+        for i0 in range(0, len(jkl), CHUNKSIZE):
+            f.write(np.asarray(jkl[i0:i0+CHUNKSIZE], dtype='>i4').tobytes())
+        f.write(b'\0' * (-4 * len(jkl) % 2880))  # pad to FITS blocks
+
+
+def add_jkl_hdf5(fn, jkl):
+    '''Add the jackknife column as a new dataset of hdf5 file.
+       The column is written CHUNKSIZE rows at a time.'''
+    import h5py
+    with h5py.File(fn, 'a') as f:
+        if 'jackknife' in f:
+            del f['jackknife']
+        col = f.create_dataset('jackknife', shape=(len(jkl),), dtype=np.int32)
+        for i0 in range(0, len(jkl), CHUNKSIZE):
+            col[i0:i0+CHUNKSIZE] = jkl[i0:i0+CHUNKSIZE]
+        if 'columns' in f.attrs and 'jackknife' not in f.attrs['columns']:
+            f.attrs['columns'] = list(f.attrs['columns']) + ['jackknife']
+
+
+JKL_WRITERS = {'npy': add_jkl_npy, 'fits': add_jkl_fits, 'hdf5': add_jkl_hdf5}
+
+
+def add_jkl(fn, jkl, fmt=None):
+    '''Add the jackknife labels of all the points (-1 if lost) to the
+       binary file fn, without rewriting the other columns.'''
+    fmt = get_fmt(fn) if fmt is None else fmt
+    if fmt not in JKL_WRITERS:
+        raise ValueError('Cannot add a column to {} file: {}'.format(fmt, fn))
+    JKL_WRITERS[fmt](fn, np.asarray(jkl, dtype=np.int32))
+    instrument.log(':: Jackknife labels added to file: {}'.format(fn))
+
+
+@contextlib.contextmanager
+def jkl_column(fn, fmt=None):
+    '''Label column of all the rows of binary file fn, memory mapped, to be
+       filled chunk by chunk in the with block and then added to fn as with
+       add_jkl. For .npy it is the final file, otherwise a temporary file
+       next to fn, so the memory used does not depend on the file size.'''
+    fmt = get_fmt(fn) if fmt is None else fmt
+    if fmt not in JKL_WRITERS:
+        raise ValueError('Cannot add a column to {} file: {}'.format(fmt, fn))
+    npts = get_npts(fn, fmt=fmt)
+    fn_col = jkl_fn_npy(fn) if fmt == 'npy' else \
+        '{0}.{1:d}.jackknife.npy'.format(fn, os.getpid())
+    jkl = np.lib.format.open_memmap(fn_col, mode='w+', dtype=np.int32,
+                                    shape=(npts,))
+    try:
+        yield jkl
+        with instrument.span('save', npts=npts):
+            jkl.flush()
+            if fmt != 'npy':
+                JKL_WRITERS[fmt](fn, jkl)
+        instrument.log(':: Jackknife labels added to file: {}'.format(fn))
+    finally:
+        del jkl
+        if fmt != 'npy':
+            os.remove(fn_col)
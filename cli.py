@@ -0,0 +1,155 @@
+'''
+Command line interface, run as python -m <package>:
+    rand   make jackknife regions with randoms, bounds and Healpix map
+    mask   make jackknife regions with a Healpix mask
+    label  label catalogs with jackknife bounds or map
+Heavy modules are only imported by the commands that need them.
+'''
+import os
+import sys
+import argparse
+from . import instrument
+
+
+def add_knife_args(parser):
+    '''Options common to rand and mask.'''
+    parser.add_argument('--njr', type=int, default=20,
+                        help='number of jackknife regions')
+    parser.add_argument('--nra', type=int, default=5,
+                        help='number of slices in RA')
+    parser.add_argument('--rra', type=float, default=0.,
+                        help='rotation in RA if the footprint crosses 0')
+    parser.add_argument('--fmap', default='',
+                        help='output jackknife regions in Healpix map')
+    parser.add_argument('--sparse', action='store_true',
+                        help='save the map as partial sky map')
+    parser.add_argument('--plot', action='store_true',
+                        help='plot the jackknife map')
+    parser.add_argument('--shuffle', action='store_true',
+                        help='shuffle the labels in the plot')
+    parser.add_argument('--nproc', type=int, default=1,
+                        help='number of processes')
+    parser.add_argument('--cache', action='store_true',
+                        help='reuse outputs for the same input and options')
+    parser.add_argument('--single', action='store_true',
+                        help='float32 randoms and integer map, less memory')
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='python -m ' + (__package__ or ''),
+                                     description='Make jackknife regions.')
+    parser.add_argument('-v', '--verbose', type=int,
+                        default=instrument.VERBOSE,
+                        help='0: silent, 1: progress, 2: timing of stages')
+    parser.add_argument('--trace', default='',
+                        help='save the timing of the stages, Chrome trace')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('rand', help='jackknife regions with randoms')
+    p.add_argument('rand', help='random file, columns: RA, DEC, Z, weight')
+    add_knife_args(p)
+    p.add_argument('--nside', type=int, default=1024,
+                   help='nside of the jackknife map')
+    p.add_argument('--fbounds', default='out_jk_bounds.dat',
+                   help='output bounds [ra_min, ra_max, dec_min, dec_max]')
+    p.add_argument('--nside-agg', type=int, default=None,
+                   help='aggregate the randoms in pixels at this nside')
+    p.add_argument('--stream', action='store_true',
+                   help='two pass knife, for randoms larger than memory')
+
+    p = sub.add_parser('mask', help='jackknife regions with mask')
+    p.add_argument('mask', help='Healpix mask, values in [0, 1]')
+    add_knife_args(p)
+
+    p = sub.add_parser('label', help='label catalogs')
+    p.add_argument('files', nargs='+', help='catalogs to label')
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument('--bounds', help='jackknife bounds file')
+    g.add_argument('--map', help='jackknife map file')
+    p.add_argument('--suffix', default='_jk',
+                   help='output of text catalog fn: root + suffix + ext; '
+                        'labels are added to binary catalogs')
+    p.add_argument('--chunksize', type=int, default=1000000)
+    p.add_argument('--nproc', type=int, default=1,
+                   help='number of processes, one file each')
+    p.add_argument('--single', action='store_true',
+                   help='RA, DEC as float32 for the labeling')
+    p.add_argument('--jk0', type=int, default=0,
+                   help='first label, the labels are [jk0, jk0+njr-1], '
+                        'e.g. to merge footprints')
+
+    return parser
+
+
+def run_rand(args):
+    from . import knife, utils
+    if args.stream:
+        res = knife.knife_rand_stream(args.rand, args.njr, args.nra, args.rra,
+                                      nside=args.nside, sparse=args.sparse,
+                                      single=args.single)
+    else:
+        res = knife.knife_rand(args.rand, args.njr, args.nra, args.rra,
+                               nside=args.nside, sparse=args.sparse,
+                               nside_agg=args.nside_agg, nproc=args.nproc,
+                               cache=args.cache, single=args.single)
+    jk_bounds, jk_map = res
+    if args.fbounds:
+        utils.save_bounds(jk_bounds, args.fbounds)
+    save_map(jk_map, args)
+
+
+def run_mask(args):
+    from . import knife
+    jk_map = knife.knife_mask(args.mask, args.njr, args.nra, args.rra, None,
+                              sparse=args.sparse, nproc=args.nproc,
+                              cache=args.cache, single=args.single)
+    save_map(jk_map, args)
+
+
+def save_map(jk_map, args):
+    from . import utils
+    if args.fmap:
+        utils.save_jk_map(jk_map, args.fmap)
+    if args.plot:
+        utils.plot_jk_map(jk_map, shuffle=args.shuffle, njr=args.njr)
+
+
+def run_label(args):
+    import numpy as np
+    from . import label, catio, utils
+    if args.bounds is not None:
+        jkr, tp = np.loadtxt(args.bounds, ndmin=2), 'bounds'
+    else:
+        jkr, tp = utils.load_jk_map(args.map, sparse=True), 'map'
+
+    fos = []
+    for fn in args.files:
+        if catio.get_fmt(fn) == 'txt':
+            root, ext = os.path.splitext(fn)
+            fos.append(root + args.suffix + ext)
+        else:
+            fos.append(None)
+    summary = label.label_files(args.files, jkr, fos=fos, tp=tp,
+                                chunksize=args.chunksize, nproc=args.nproc,
+                                dtype=np.float32 if args.single
+                                else np.float64, jk0=args.jk0)
+
+    return summary
+
+
+COMMANDS = {'rand': run_rand, 'mask': run_mask, 'label': run_label}
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    instrument.set_verbose(args.verbose)
+    with instrument.span(args.command):
+        COMMANDS[args.command](args)
+    if args.trace:
+        instrument.save_trace(args.trace)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
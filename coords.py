@@ -0,0 +1,158 @@
+'''
+Coordinate transforms between equatorial RA, DEC [degree] and galactic
+theta, phi [radians] / pixels used in Healpy.
+Rotation matrices are cached, points are transformed in chunks.
+'''
+import os
+import functools
+import numpy as np
+from . import cache
+from . import instrument
+
+
+CHUNKSIZE = 1 << 20  # number of points transformed at a time
+
+
+@functools.lru_cache(maxsize=None)
+def get_rot_mat(coord_in, coord_out):
+    '''Rotation matrix from coord_in to coord_out, e.g. 'C' to 'G'.'''
+    import healpy as hp
+    return hp.Rotator(coord=[coord_in, coord_out]).mat
+
+
+def radec2vec(ra, dec, mat=None, dtype=np.float64):
+    '''Unit vectors (3, n) of RA, DEC [degree], rotated by mat.'''
+    ra, dec = np.deg2rad(ra, dtype=dtype), np.deg2rad(dec, dtype=dtype)
+    cos_dec = np.cos(dec)
+    vec = np.empty((3, len(ra)), dtype=dtype)
+    np.multiply(cos_dec, np.cos(ra), out=vec[0])
+    np.multiply(cos_dec, np.sin(ra), out=vec[1])
+    np.sin(dec, out=vec[2])
+    if mat is not None:
+        vec = mat.astype(dtype) @ vec
+
+    return vec
+
+
+def vec2thetaphi(vec):
+    '''theta, phi [radians] of vectors (3, n), phi in [0, 2pi).'''
+    theta = np.arctan2(np.sqrt(vec[0]**2 + vec[1]**2), vec[2])
+    phi = np.arctan2(vec[1], vec[0])
+    phi[phi < 0.] += 2*np.pi
+
+    return theta, phi
+
+
+def thetaphi2vec(theta, phi, mat=None, dtype=np.float64):
+    '''Unit vectors (3, n) of theta, phi [radians], rotated by mat.'''
+    theta, phi = np.asarray(theta, dtype=dtype), np.asarray(phi, dtype=dtype)
+    sin_theta = np.sin(theta)
+    vec = np.empty((3, len(theta)), dtype=dtype)
+    np.multiply(sin_theta, np.cos(phi), out=vec[0])
+    np.multiply(sin_theta, np.sin(phi), out=vec[1])
+    np.cos(theta, out=vec[2])
+    if mat is not None:
+        vec = mat.astype(dtype) @ vec
+
+    return vec
+
+
+def vec2radec(vec):
+    '''RA, DEC [degree] of vectors (3, n), RA in [0, 360].'''
+    theta = np.arctan2(np.sqrt(vec[0]**2 + vec[1]**2), vec[2])
+    ra = np.rad2deg(np.arctan2(vec[1], vec[0]))
+    ra[ra < 0.] += 360.  # move RA in [-180,0) to [180,360)
+
+    return ra, 90. - np.rad2deg(theta)
+
+
+def radec2thetaphi(ra, dec, dtype=np.float64, chunksize=CHUNKSIZE):
+    '''Galactic theta, phi [radians] from equatorial RA, DEC [degree].'''
+    mat = get_rot_mat('C', 'G')
+    theta = np.empty(len(ra), dtype=dtype)
+    phi = np.empty(len(ra), dtype=dtype)
+    for i0 in range(0, len(ra), chunksize):
+        s = slice(i0, i0 + chunksize)
+        theta[s], phi[s] = vec2thetaphi(radec2vec(ra[s], dec[s], mat, dtype))
+
+    return theta, phi
+
+
+def thetaphi2radec(theta, phi, dtype=np.float64, chunksize=CHUNKSIZE):
+    '''Equatorial RA, DEC [degree] from galactic theta, phi [radians].'''
+    mat = get_rot_mat('G', 'C')
+    ra = np.empty(len(theta), dtype=dtype)
+    dec = np.empty(len(theta), dtype=dtype)
+    for i0 in range(0, len(theta), chunksize):
+        s = slice(i0, i0 + chunksize)
+        ra[s], dec[s] = vec2radec(thetaphi2vec(theta[s], phi[s], mat, dtype))
+
+    return ra, dec
+
+
+def radec2pix(nside, ra, dec, nest=False, dtype=np.float64,
+              chunksize=CHUNKSIZE):
+    '''Galactic Healpix pixels of equatorial RA, DEC [degree].'''
+    import healpy as hp
+    mat = get_rot_mat('C', 'G')
+    ipix = np.empty(len(ra), dtype=np.int64)
+    for i0 in range(0, len(ra), chunksize):
+        s = slice(i0, i0 + chunksize)
+        vec = radec2vec(ra[s], dec[s], mat, dtype)
+        ipix[s] = hp.vec2pix(nside, vec[0], vec[1], vec[2], nest=nest)
+
+    return ipix
+
+
+def pix2radec(nside, ipix, nest=False, dtype=np.float64,
+              chunksize=CHUNKSIZE):
+    '''Equatorial RA, DEC [degree] of galactic Healpix pixel centers.'''
+    import healpy as hp
+    mat = get_rot_mat('G', 'C')
+    ra = np.empty(len(ipix), dtype=dtype)
+    dec = np.empty(len(ipix), dtype=dtype)
+    for i0 in range(0, len(ipix), chunksize):
+        s = slice(i0, i0 + chunksize)
+        vec = np.array(hp.pix2vec(nside, ipix[s], nest=nest), dtype=dtype)
+        ra[s], dec[s] = vec2radec(mat.astype(dtype) @ vec)
+
+    return ra, dec
+
+
+def get_pix_radec(nside, ipix=None, nest=False, use_cache=True):
+    '''RA, DEC [degree] of the galactic Healpix pixel centers ipix, all the
+       pixels if None, (2, len(ipix)).
+       Computed once per nside and ordering, then memory mapped from the
+       disk cache (cache.CACHE_DIR). Without the cache only the pixels
+       ipix are computed.'''
+    npix = 12 * nside**2
+    size = 2 * npix * np.dtype(np.float64).itemsize
+    if not use_cache or size > cache.CACHE_SIZE:
+        ipix = np.arange(npix) if ipix is None else ipix
+        return np.array(pix2radec(nside, ipix, nest=nest))
+
+    cache_dir = cache.get_cache_dir('pix_radec')
+    fn = os.path.join(cache_dir, 'nside{0:d}_{1}.npy'.format(
+        nside, 'nest' if nest else 'ring'))
+    if os.path.exists(fn):
+        cache.touch(fn)
+        return get_pix(np.load(fn, mmap_mode='r'), ipix)
+
+    instrument.log('>> Caching RA, DEC of pixel centers: {}'.format(fn))
+    cache.evict(cache_dir, cache.CACHE_SIZE, size_new=size)
+    fn_tmp = os.path.join(cache_dir, '.{0:d}.npy'.format(os.getpid()))
+    radec = np.lib.format.open_memmap(fn_tmp, mode='w+', dtype=np.float64,
+                                      shape=(2, npix))
+    for i0 in range(0, npix, CHUNKSIZE):
+        pix = np.arange(i0, min(i0 + CHUNKSIZE, npix))
+        radec[0, pix], radec[1, pix] = pix2radec(nside, pix, nest=nest)
+    radec.flush()
+    del radec
+    os.replace(fn_tmp, fn)  # other processes only see the complete file
+
+    return get_pix(np.load(fn, mmap_mode='r'), ipix)
+
+
+def get_pix(radec, ipix):
+    '''Columns ipix of the table radec, all if ipix is None.'''
+    return radec if ipix is None else radec[:, ipix]
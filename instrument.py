@@ -0,0 +1,122 @@
+'''
+Progress messages and timing of the pipeline stages.
+Messages go through log, shown up to the verbosity level: 0 silent,
+1 the usual progress messages, 2 also the timing of each span.
+Spans record the wall time, number of points and peak memory of a stage,
+in the calling process only, and are exported as JSON or as a Chrome
+trace (chrome://tracing, Perfetto).
+'''
+import os
+import sys
+import json
+import time
+import resource
+import threading
+import contextlib
+
+
+# set with environment variable COSMOKNIFE_VERBOSE
+VERBOSE = int(os.environ.get('COSMOKNIFE_VERBOSE', 1))
+
+_spans = []  # finished spans, in the order they end
+_stack = threading.local()  # names of the open spans, per thread
+_t0 = time.perf_counter()  # time origin of the spans
+
+
+def set_verbose(level):
+    '''Set the verbosity level.'''
+    global VERBOSE
+    VERBOSE = int(level)
+
+
+def log(msg, level=1):
+    '''Print msg if the verbosity level is at least level.'''
+    if VERBOSE >= level:
+        print(msg)
+
+
+def get_peak_rss():
+    '''Peak resident set size of the process [MB].'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return rss / 1024.**2 if sys.platform == 'darwin' else rss / 1024.
+
+
+@contextlib.contextmanager
+def span(name, npts=None):
+    '''Record the stage name around the with block, npts points processed.
+       The record is given to the block, e.g. to set npts when known.'''
+    rec = {'name': name, 'npts': npts}
+    stack = _stack.__dict__.setdefault('names', [])
+    parent = stack[-1] if stack else None
+    stack.append(name)
+    rss0 = get_peak_rss()
+    t0 = time.perf_counter()
+    try:
+        yield rec
+    finally:
+        wall = time.perf_counter() - t0
+        stack.pop()
+        npts = rec['npts']
+        rec.update({'parent': parent, 'depth': len(stack),
+                    'start': t0 - _t0, 'wall': wall,
+                    'npts': None if npts is None else int(npts),
+                    'peak_rss_mb': get_peak_rss(),
+                    'rss_growth_mb': get_peak_rss() - rss0,
+                    'pid': os.getpid(), 'tid': threading.get_ident()})
+        _spans.append(rec)
+        log('-- [{0}] {1:.3f} s{2}, peak RSS {3:.1f} MB'.format(
+            name, wall, '' if npts is None else
+            ', {0:d} points, {1:.3e} /s'.format(int(npts),
+                                                npts / max(wall, 1e-9)),
+            rec['peak_rss_mb']), level=2)
+
+
+def get_spans():
+    '''Records of the finished spans.'''
+    return list(_spans)
+
+
+def clear():
+    '''Forget the finished spans.'''
+    del _spans[:]
+
+
+def summary():
+    '''Total wall time and points per span name, in order of first use.'''
+    res = {}
+    for rec in _spans:
+        s = res.setdefault(rec['name'], {'calls': 0, 'wall': 0., 'npts': 0})
+        s['calls'] += 1
+        s['wall'] += rec['wall']
+        s['npts'] += rec['npts'] or 0
+
+    return res
+
+
+def print_summary():
+    '''Print the summary of the spans.'''
+    print('-- Time per stage: calls, wall time, points')
+    for name, s in summary().items():
+        print('-- {0}: {1:d}, {2:.3f} s, {3:d}'.format(
+            name, s['calls'], s['wall'], s['npts']))
+
+
+def save_json(fn):
+    '''Save the records of the spans to JSON file.'''
+    with open(fn, 'w') as f:
+        json.dump({'spans': _spans, 'summary': summary()}, f, indent=1)
+    log(':: Spans saved to file: {}'.format(fn))
+
+
+def save_trace(fn):
+    '''Save the spans in Chrome trace event format.'''
+    events = [{'name': rec['name'], 'ph': 'X', 'ts': 1e6 * rec['start'],
+               'dur': 1e6 * rec['wall'], 'pid': rec['pid'],
+               'tid': rec['tid'],
+               'args': {'npts': rec['npts'],
+                        'peak_rss_mb': rec['peak_rss_mb']}}
+              for rec in _spans]
+    with open(fn, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    log(':: Trace saved to file: {}'.format(fn))
@@ -0,0 +1,72 @@
+'''
+Jackknife statistics from per region partial sums.
+For an additive statistic, the leave-one-out sums are the total minus the
+sums of each region, so all of them cost O(N + njr * nbins).
+'''
+import numpy as np
+
+
+def get_njr(jkl):
+    '''Number of jackknife regions, labels start from 0.'''
+    return int(np.amax(jkl)) + 1
+
+
+def region_sums(jkl, weights=None, ibin=None, nbins=1, njr=None):
+    '''Sums of weights (1 by default) per region and bin, shape (njr, nbins).
+       jkl: jackknife labels, e.g. the last column of labeled data;
+       ibin: bin index of each point in [0, nbins).
+       Points with label or bin -1 are left out.'''
+    jkl = np.asarray(jkl).astype(np.int64)
+    njr = get_njr(jkl) if njr is None else njr
+    ibin = np.zeros(len(jkl), dtype=np.int64) if ibin is None else ibin
+
+    keep = (jkl != -1) & (ibin != -1)
+    k = jkl[keep] * nbins + ibin[keep]
+    w = None if weights is None else np.asarray(weights)[keep]
+
+    return np.bincount(k, weights=w, minlength=njr*nbins).reshape(njr, nbins)
+
+
+def get_ibin(x, bins):
+    '''Bin index of x with bin edges bins, -1 if out of range.'''
+    ibin = np.searchsorted(bins, x, side='right') - 1
+    ibin[x == bins[-1]] = len(bins) - 2  # last bin includes the right edge
+    ibin[(ibin < 0) | (ibin >= len(bins) - 1)] = -1
+
+    return ibin
+
+
+def region_hist(jkl, x, bins, weights=None, njr=None):
+    '''Histogram of x per region, shape (njr, len(bins)-1),
+       e.g. x the redshift column of labeled data.'''
+    return region_sums(jkl, weights=weights, ibin=get_ibin(x, bins),
+                       nbins=len(bins) - 1, njr=njr)
+
+
+def loo_sums(part):
+    '''Leave-one-out sums from per region sums part, shape (njr, ...).'''
+    return np.sum(part, axis=0) - part
+
+
+def jk_mean_cov(est):
+    '''Jackknife mean and covariance of leave-one-out estimates,
+       shape (njr, nbins).'''
+    est = np.asarray(est).reshape(len(est), -1)
+    njr = len(est)
+    mean = np.mean(est, axis=0)
+    d = est - mean
+    cov = (njr - 1.) / njr * (d.T @ d)
+
+    return mean, cov
+
+
+def jackknife(*parts, func=None):
+    '''Jackknife mean and covariance from per region sums.
+       Each of parts has shape (njr, nbins). The leave-one-out estimates
+       are func(*loo_sums) evaluated for all regions at once, or the
+       leave-one-out sums of parts[0] if func is None, e.g.
+       func=lambda dd, rr: dd / rr - 1.'''
+    loos = [loo_sums(part) for part in parts]
+    est = loos[0] if func is None else func(*loos)
+
+    return jk_mean_cov(est)
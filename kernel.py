@@ -2,85 +2,162 @@
 Kernel functions.
 '''
 import numpy as np
-import healpy as hp
 from . import utils
+from . import coords
+from . import parallel
+from . import instrument
 import collections
 
 
-def cut_in_ra(rand, w_ra, rra, nra):
-    '''Cut in the RA direction. RA in [0, 360].'''
-    d_ra = collections.OrderedDict()
-    if nra == 1:  # only one RA piece
-        d_ra = rand.copy()
-        return d_ra
+# points of region i: idx[offsets[i]:offsets[i+1]]
+Regions = collections.namedtuple('Regions', ['idx', 'offsets'])
+MAP_BLOCKSIZE = 1 << 24  # points of a block of make_jk_map
 
-    print('>> Cutting in the RA direction')
+
+def cut_weights(w, w_cut, cw=None):
+    '''Cut the sorted weights w into len(w_cut)+1 pieces.
+       Piece j ends at the first point where its weight exceeds w_cut[j],
+       the last piece takes the rest. Return the offsets of the pieces.
+       cw: cumulative weights of w, if known.
+       Weights are summed in double precision, also for float32 w.'''
+    n = len(w)
+    if cw is None:
+        # global cumulative weights, for the estimate
+        cw = np.cumsum(w, dtype=np.float64)
+    offsets = [0]
+    for wc in w_cut:
+        i0 = offsets[-1]
+        c0 = cw[i0-1] if i0 > 0 else 0.
+        # estimate the cut from the global cumulative weights,
+        # then refine it with the running sum of the piece
+        i1 = min(n, np.searchsorted(cw, c0 + wc, side='right') + 1024)
+        while True:
+            cw_p = np.cumsum(w[i0:i1], dtype=np.float64)
+            k = np.searchsorted(cw_p, wc, side='right')
+            if k < len(cw_p) or i1 == n:
+                break
+            i1 = n
+        if k == len(cw_p):  # not enough weight left, drop the rest
+            return np.array(offsets)
+        offsets.append(i0 + k + 1)
+
+    offsets.append(n)
+
+    return np.array(offsets)
+
+
+def get_ra_rot(ra, rra):
+    '''RA rotated by rra [degree], for regions crossing 0.
+       Computed in double precision, also for float32 RA.'''
+    ra = np.asarray(ra, dtype=np.float64)
+    if rra != 0.:
+        return (ra + rra) % 360.
+    else:
+        return ra
+
+
+def get_w_total(w):
+    '''Total weight, summed in double precision.'''
+    return np.sum(np.asarray(w, dtype=np.float64))
+
+
+def get_ra_bins(ra, rra, nbins):
+    '''Bins of the RA rotated by rra, nbins equal bins in [0, 360].'''
+    ibin = (get_ra_rot(ra, rra) * (nbins / 360.)).astype(np.int64)
+    return np.minimum(ibin, nbins - 1)
+
+
+def cut_hist(hist, w_cut):
+    '''Cut the weight histogram hist into len(w_cut)+1 pieces, at the bin
+       edges closest to the cumulative weights of w_cut. The weight of each
+       piece is off by at most one bin at each end.
+       Return the bin edges of the pieces.'''
+    cum = np.concatenate(([0.], np.cumsum(hist, dtype=np.float64)))
+    target = np.cumsum(w_cut)
+    j = np.clip(np.searchsorted(cum, target), 1, len(hist))
+    j = np.where(target - cum[j-1] < cum[j] - target, j - 1, j)
+
+    return np.concatenate(([0], np.maximum.accumulate(j), [len(hist)]))
+
+
+def cut_in_ra(data, w_ra, rra, idx=None):
+    '''Cut in the RA direction. RA in [0, 360].
+       idx: the points already sorted along the rotated RA, if known.
+       Return the RA order of the points and the offsets of the RA pieces.'''
+    if len(w_ra) == 1:  # only one RA piece
+        return np.arange(len(data)), np.array([0, len(data)])
+
+    instrument.log('>> Cutting in the RA direction')
 
     if rra != 0.:  # rotate rra if cross 0
-        print('++ Rotate RA for {0:f} degrees'.format(rra))
-        tmp = (rand[:, 0] + rra) % 360.
+        instrument.log('++ Rotate RA for {0:f} degrees'.format(rra))
+
+    if idx is None:
+        with instrument.span('rotate', npts=len(data)):
+            ra_rot = get_ra_rot(data[:, 0], rra)
+        with instrument.span('sort', npts=len(data)):
+            idx = ra_rot.argsort()  # sort along RA
     else:
-        tmp = rand[:, 0]
-
-    rand = np.column_stack((rand, tmp))  # helping column for RA
-
-    rand = rand[rand[:, 3].argsort()]  # sort along RA
-    tmp, i0, j = 0., 0, 0
-
-    counter = 0
-    for i1, p in enumerate(rand, 1):
-        tmp += p[2]
-        if tmp > w_ra[j]:
-            counter += 1
-            d_ra[j] = rand[i0:i1, :]
-            j += 1
-            tmp = 0.
-            i0 = i1
-            if counter == nra - 1:  # last RA piece
-                d_ra[j] = rand[i0:, :]
-                break
+        idx = np.array(idx)  # sorted in place later
+
+    with instrument.span('cut_ra', npts=len(data)):
+        offsets = cut_weights(data[idx, 2], w_ra[:-1])
+
+    return idx, offsets
 
-    del rand
 
-    return d_ra
+def cut_piece_in_dec(task):
+    '''Sort the RA piece idx[i0:i1] along DEC in place, unless already
+       sorted, and cut it. Return the offsets of the DEC pieces.'''
+    i0, i1, n_dec, w_dec, done = task
+    if n_dec == 1:  # only one DEC piece
+        return np.array([0, i1 - i0])
+    data, idx = parallel.get_array('data'), parallel.get_array('idx')
+    sub = idx[i0:i1]  # points in the RA piece
+    if not done:
+        sub[...] = sub[data[sub, 1].argsort()]  # sort along DEC
 
+    return cut_weights(data[sub, 2], np.full(n_dec - 1, w_dec))
 
-def cut_in_dec(d_ra, w_dec, n_dec):
-    '''Cut in the DEC direction. DEC in [-90, 90].'''
-    print('>> Cutting in the DEC direction')
-    d_dec = collections.OrderedDict()
-    j = 0
-    for i in range(len(d_ra)):
-        if n_dec[i] == 1:  # only one DEC piece
-            d_dec[j] = d_ra[i]
-            j += 1
 
-        rand = d_ra[i]  # points in the RA piece
-        rand = rand[rand[:, 1].argsort()]  # sort each RA piece along DEC
-        tmp, i0 = 0, 0
+def cut_in_dec(data, idx, offsets_ra, w_dec, n_dec, strips=None, nproc=1):
+    '''Cut in the DEC direction. DEC in [-90, 90].
+       Each RA piece of idx is sorted along DEC in place.
+       strips: cache of the RA pieces sorted along DEC, by range of idx.
+       The RA pieces are cut over nproc processes, with the same result.
+       Return the point indices and the offsets of the regions.'''
+    instrument.log('>> Cutting in the DEC direction')
+    tasks = []
+    for i in range(len(offsets_ra) - 1):
+        i0, i1 = int(offsets_ra[i]), int(offsets_ra[i+1])
+        done = strips is not None and (i0, i1) in strips
+        if done:
+            idx[i0:i1] = strips[(i0, i1)]
+        tasks.append((i0, i1, int(n_dec[i]), w_dec, done))
 
-        counter = 0
-        for i1, p in enumerate(rand, 1):
-            tmp += p[2]
-            if tmp > w_dec:
-                counter += 1
-                d_dec[j] = rand[i0:i1, :]
-                j += 1
-                tmp = 0.
-                i0 = i1
-                if counter == n_dec[i] - 1:  # last DEC piece
-                    d_dec[j] = rand[i0:, :]
-                    j += 1
-                    break
+    with instrument.span('cut_dec', npts=len(idx)):
+        offsets_dec = parallel.run(cut_piece_in_dec, tasks,
+                                   {'data': data, 'idx': idx}, nproc=nproc,
+                                   out=('idx',))
 
-    del d_ra
+    offsets = [0]
+    kept = []  # ranges of idx covered by the regions
+    for (i0, i1, n, _, done), off in zip(tasks, offsets_dec):
+        if strips is not None and n > 1 and not done:
+            strips[(i0, i1)] = idx[i0:i1].copy()
+        kept.append((i0, i0 + off[-1]))
+        offsets.extend(offsets[-1] + off[1:])
 
-    return d_dec
+    # drop the points left over at the end of the pieces, if any
+    if kept[-1][1] != len(idx) or \
+            any(r[1] != r_n[0] for r, r_n in zip(kept[:-1], kept[1:])):
+        idx = np.concatenate([idx[j0:j1] for j0, j1 in kept])
 
+    return idx, np.array(offsets)
 
-def knife(data, njr, nra, rra):
-    '''Knife function. data includes 3 columns [ra, dec, weight].'''
-    w_total = np.sum(data[:, 2])
+
+def get_piece_weights(w_total, njr, nra):
+    '''Weights of the RA pieces and number of DEC pieces per RA piece.'''
     w_dec = w_total / njr  # weight for final jackknife regions
 
     # make weights for RA pieces
@@ -96,41 +173,155 @@ def knife(data, njr, nra, rra):
             w_ra = np.append(w_ra, res * w_dec)
             n_dec = np.append(n_dec, res)
 
-    d_ra = cut_in_ra(data, w_ra, rra, nra)
+    return w_ra, n_dec
+
+
+def knife(data, njr, nra, rra, idx=None, nproc=1):
+    '''Knife function. data includes 3 columns [ra, dec, weight].
+       idx: the points already sorted along the rotated RA, if known;
+       nproc: number of processes for the DEC cuts, the point order is then
+       kept in shared memory for the later stages, see parallel.empty.
+       Region i has the points data[idx[offsets[i]:offsets[i+1]]].
+       data can be float32 to halve the memory: RA rotation and weight sums
+       are done in double precision, so the regions are the same as with
+       float64 data of the same values, e.g. float32 columns of the source
+       catalog, if no two points share the rotated RA or the DEC. Otherwise
+       rounding to float32 (relative 6e-8) can move the points that close
+       to a cut only.'''
+    w_total = get_w_total(data[:, 2])
+    w_dec = w_total / njr  # weight for final jackknife regions
+    w_ra, n_dec = get_piece_weights(w_total, njr, nra)
+
+    idx, offsets_ra = cut_in_ra(data, w_ra, rra, idx=idx)
+    if nproc > 1:
+        idx = parallel.to_shared(idx)
+
+    idx, offsets = cut_in_dec(data, idx, offsets_ra, w_dec, n_dec,
+                              nproc=nproc)
+    if nproc > 1:  # new array if points were dropped
+        idx = parallel.to_shared(idx)
 
-    d_dec = cut_in_dec(d_ra, w_dec, n_dec)
+    return Regions(idx, offsets)
 
-    return d_dec
 
+def get_labels(regions, npts):
+    '''Per point jackknife labels, -1 for the points not in any region.'''
+    njr = len(regions.offsets) - 1
+    jkl = np.full(npts, -1, dtype=utils.get_label_dtype(njr))
+    jkl[regions.idx[:regions.offsets[-1]]] = np.repeat(
+        np.arange(len(regions.offsets) - 1), np.diff(regions.offsets))
 
-def make_jk_bounds(d_dec):
-    '''Make bounds [ra_min, ra_max, dec_min, dec_max] for jackknife regions.'''
-    print('>> Making RA, DEC bounds for jackknife regions')
-    jk_bounds = np.zeros((len(d_dec), 4))
+    return jkl
 
-    for i in range(len(d_dec)):
-        rand = d_dec[i]
-        k = np.argmin(rand[:, 3])
-        jk_bounds[i, 0] = rand[k, 0]  # RA min
-        k = np.argmax(rand[:, 3])
-        jk_bounds[i, 1] = rand[k, 0]  # RA max
-        jk_bounds[i, 2] = np.amin(rand[:, 1])  # DEC min
-        jk_bounds[i, 3] = np.amax(rand[:, 1])  # DEC max
+
+def get_blocks(n, nblocks):
+    '''Split range(n) into at most nblocks contiguous blocks (i0, i1).'''
+    edges = np.linspace(0, n, min(n, nblocks) + 1).astype(np.int64)
+    return [(int(i0), int(i1)) for i0, i1 in zip(edges[:-1], edges[1:])]
+
+
+def bounds_block(task):
+    '''Bounds of the regions [i0, i1), see make_jk_bounds.'''
+    i0, i1, rra = task
+    data, idx = parallel.get_array('data'), parallel.get_array('idx')
+    offsets = parallel.get_array('offsets')
+    jk_bounds = np.zeros((i1 - i0, 4))
+
+    for i in range(i0, i1):
+        sub = idx[offsets[i]:offsets[i+1]]
+        ra, dec = data[sub, 0], data[sub, 1]
+        ra_rot = get_ra_rot(ra, rra)
+        jk_bounds[i-i0, 0] = ra[np.argmin(ra_rot)]  # RA min
+        jk_bounds[i-i0, 1] = ra[np.argmax(ra_rot)]  # RA max
+        jk_bounds[i-i0, 2] = np.amin(dec)  # DEC min
+        jk_bounds[i-i0, 3] = np.amax(dec)  # DEC max
 
     return jk_bounds
 
 
-def make_jk_map(d_dec, nside):
-    '''Make healpix map for the jackknife regions.'''
-    print('>> Making healpix map for jackknife regions')
-    npix = hp.nside2npix(nside)
-    jk_map = np.full(npix, hp.UNSEEN)
+def make_jk_bounds(data, regions, rra, nproc=1):
+    '''Make bounds [ra_min, ra_max, dec_min, dec_max] for jackknife regions.
+       The regions are split in blocks over nproc processes.'''
+    instrument.log('>> Making RA, DEC bounds for jackknife regions')
+    idx, offsets = regions
+    tasks = [(i0, i1, rra)
+             for i0, i1 in get_blocks(len(offsets) - 1, 4 * nproc)]
+    with instrument.span('bounds', npts=offsets[-1]):
+        blocks = parallel.run(bounds_block, tasks,
+                              {'data': data, 'idx': idx, 'offsets': offsets},
+                              nproc=nproc)
+
+    return np.concatenate(blocks + [np.zeros((0, 4))])
+
+
+def pix_block(task):
+    '''Pixels of the points idx[b0+j0:b0+j1] written to the shared pix.'''
+    b0, j0, j1, nside = task
+    data, idx = parallel.get_array('data'), parallel.get_array('idx')
+    sub = idx[b0+j0:b0+j1]
+    parallel.get_array('pix')[j0:j1] = coords.radec2pix(
+        nside, data[sub, 0], data[sub, 1])
+
+
+def make_jk_map(data, regions, nside, sparse=False, nproc=1,
+                dtype=np.float64):
+    '''Make healpix map for the jackknife regions.
+       The points are taken in blocks of MAP_BLOCKSIZE in region order, or
+       all at once if nproc > 1, and their pixels found over nproc
+       processes.
+       Return utils.SparseMap if sparse, otherwise full sky map of type
+       dtype, UNSEEN (float) or -1 (integer) if not covered.'''
+    instrument.log('>> Making healpix map for jackknife regions')
+    idx, offsets = regions
+    npts, npix = int(offsets[-1]), utils.nside2npix(nside)
+    # one block over processes, the data may be copied to shared memory
+    blocksize = MAP_BLOCKSIZE if nproc == 1 else max(npts, 1)
+    with instrument.span('map', npts=npts):
+        pix = (np.empty if nproc == 1 else parallel.empty)(
+            min(blocksize, npts), np.int32 if npix < 2**31 else np.int64)
+        if sparse:
+            jk_map = utils.make_sparse_map(nside, np.zeros(0, dtype=np.int64),
+                                           np.zeros(0, dtype=np.int64))
+        else:
+            jk_map = np.full(npix, utils.get_map_fill(dtype), dtype=dtype)
+
+        for b0 in range(0, npts, blocksize):
+            b1 = min(b0 + blocksize, npts)
+            tasks = [(b0, j0, j1, nside) for j0, j1 in get_blocks(
+                b1 - b0, max(4 * nproc, (b1 - b0) // coords.CHUNKSIZE))]
+            parallel.run(pix_block, tasks,
+                         {'data': data, 'idx': idx, 'pix': pix},
+                         nproc=nproc, out=('pix',))
+
+            # regions in the block, later regions win on shared pixels
+            i0 = np.searchsorted(offsets, b0, side='right') - 1
+            i1 = np.searchsorted(offsets, b1, side='left')
+            if sparse:
+                jkl = np.repeat(np.arange(i0, i1), np.diff(
+                    np.clip(offsets[i0:i1+1], b0, b1)))
+                jk_map = utils.make_sparse_map(
+                    nside, np.concatenate((jk_map.ipix, pix[:b1-b0])),
+                    np.concatenate((jk_map.jkl, jkl)))
+                continue
+            for i in range(i0, i1):
+                lo, hi = max(offsets[i], b0), min(offsets[i+1], b1)
+                jk_map[pix[lo-b0:hi-b0]] = i
+
+    return jk_map
+
+
+def make_jk_map_w_pix(ipix, regions, nside, sparse=False, dtype=np.float64):
+    '''Make healpix map for the jackknife regions of the sorted pixels ipix.
+       Return utils.SparseMap if sparse, otherwise full sky map of type
+       dtype, see make_jk_map.'''
+    instrument.log('>> Making healpix map for jackknife regions')
+    with instrument.span('map', npts=len(ipix)):
+        jkl = get_labels(regions, len(ipix))
+        if sparse:
+            return utils.SparseMap(nside, ipix[jkl != -1], jkl[jkl != -1])
 
-    for i in range(len(d_dec)):
-        rand = d_dec[i]
-        # convert to theta, phi used by default in Healpy
-        theta_gal, phi_gal = utils.get_theta_phi(rand[:, 0], rand[:, 1])
-        ipix = hp.ang2pix(nside, theta_gal, phi_gal)
-        jk_map[ipix] = i
+        fill = utils.get_map_fill(dtype)
+        jk_map = np.full(utils.nside2npix(nside), fill, dtype=dtype)
+        jk_map[ipix] = np.where(jkl != -1, jkl, fill)
 
     return jk_map
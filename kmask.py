@@ -1,47 +1,121 @@
 '''
 Make jackknife Healpix masks.
 '''
-import healpy as hp
 import numpy as np
-import matplotlib.pyplot as plt
 from . import utils
+from . import coords
+from . import instrument
 
 
-def jk_masks_w_bounds(mask, bound, froot, test=True):
-    '''Make jackknife masks with bounds.'''
-    nside = hp.get_nside(mask)
-    npix = hp.nside2npix(nside)
+def save_jk_masks(mask, jk_lab, fn):
+    '''Save the mask and the jackknife label map in one fits file.
+       All the jackknife masks can be made from these two maps.'''
+    import healpy as hp
+    with instrument.span('save', npts=len(mask)):
+        hp.write_map(fn, [mask, jk_lab], dtype=[mask.dtype, np.int32],
+                     column_names=['MASK', 'JK'], overwrite=True)
+    instrument.log(':: Jackknife masks saved to file: {}'.format(fn))
 
-    ipix = np.arange(npix)
-    # get RA, DEC for all pixels
-    theta_gal, phi_gal = hp.pix2ang(nside, ipix)
-    ra, dec = utils.get_ra_dec(theta_gal, phi_gal)
 
-    idx = np.where(mask > 0.)
-    dec, ra, ipix = dec[idx], ra[idx], ipix[idx]
-    npix_c = len(dec)
+def load_jk_masks(fn, memmap=False):
+    '''Load the mask and the jackknife label map saved by save_jk_masks.'''
+    import healpy as hp
+    instrument.log('>> Loading jackknife masks: {}'.format(fn))
+    mask = hp.read_map(fn, field=0, dtype=None, memmap=memmap)
+    jk_lab = hp.read_map(fn, field=1, dtype=None, memmap=memmap)
 
-    if test:
-        test_mask = np.ones(npix)
+    return mask, jk_lab
+
+
+def get_jk_mask(mask, jk_lab, k):
+    '''Jackknife mask k, i.e. the mask with region k set to zero.'''
+    return np.where(jk_lab == k, 0., mask)
+
+
+def iter_jk_masks(mask, jk_lab, njr):
+    '''Iterate over the jackknife masks of the njr regions in the order of
+       the labels, a region with no pixel in jk_lab gives the mask itself.
+       The same array is reused for all the masks, copy it to keep one.'''
+    ipix = np.flatnonzero(jk_lab >= 0)
+    jkl = jk_lab[ipix]
+    order = np.argsort(jkl, kind='stable')
+    ipix, jkl = ipix[order], jkl[order]
+    offsets = np.searchsorted(jkl, np.arange(njr + 1))
+
+    jk_mask = np.array(mask, dtype=np.float64)
+    for j in range(njr):
+        pix = ipix[offsets[j]:offsets[j+1]]
+        jk_mask[pix] = 0.  # set pixels in the jk region to zero
+        yield jk_mask
+        jk_mask[pix] = mask[pix]
 
-    for j, r in enumerate(bound):  # loop over bounds
-        jk_mask = np.copy(mask)
 
-        for i in range(npix_c):  # loop over pixels covered
-            if dec[i] >= r[2] and dec[i] <= r[3]:  # DEC
-                if r[0] < r[1]:
-                    if ra[i] >= r[0] and ra[i] <= r[1]:
-                        jk_mask[ipix[i]] = 0.  # set pixel in the jk region to zero
-                else:  # regions crossing zero
-                    if ra[i] >= r[0] or ra[i] <= r[1]:
-                        jk_mask[ipix[i]] = 0.
+def write_jk_masks(mask, jk_lab, njr, froot, test=True):
+    '''Write the jackknife mask of each of the njr regions to its own
+       fits file.
+       Only for tools that need the masks one by one,
+       save_jk_masks keeps the same information in one file.'''
+    import healpy as hp
+    if test:
+        test_mask = np.ones(len(mask))
 
+    for j, jk_mask in enumerate(iter_jk_masks(mask, jk_lab, njr)):
         fn = froot + '_jk_{0:d}.fits'.format(j)
         hp.write_map(fn, jk_mask, dtype=jk_mask.dtype, overwrite=True)
-        print('>> jk mask {0:d} : {1:s}'.format(j, fn))
+        instrument.log('>> jk mask {0:d} : {1:s}'.format(j, fn))
         if test:
             test_mask = test_mask * jk_mask
 
     if test:
+        import matplotlib.pyplot as plt
         hp.mollview(test_mask, coord='GC')
         plt.show()
+
+
+def jk_masks_w_bounds(mask, bound, froot, test=True, legacy=False):
+    '''Make jackknife masks with bounds.
+       Pixels in more than one bound go to the first one, as in labeling.
+       The masks are saved in one file, or one file per mask if legacy.'''
+    nside = utils.npix2nside(len(mask))
+    npix = utils.nside2npix(nside)
+
+    ipix = np.flatnonzero(mask > 0.)  # pixels covered
+    # get RA, DEC for the pixels covered
+    ra, dec = coords.get_pix_radec(nside, ipix)
+
+    # label the pixels covered with the regions, once for all the regions
+    with instrument.span('label', npts=len(ipix)):
+        index = utils.make_bounds_index(bound)
+        jk_lab = np.full(npix, -1, dtype=np.int32)
+        jk_lab[ipix] = utils.lookup_bounds(index, ra, dec)
+
+    if legacy:
+        write_jk_masks(mask, jk_lab, len(bound), froot, test=test)
+        return
+
+    save_jk_masks(mask, jk_lab, froot + '_jk_masks.fits')
+
+    if test:
+        import healpy as hp
+        import matplotlib.pyplot as plt
+        hp.mollview(np.where(jk_lab >= 0, 0., mask), coord='GC')
+        plt.show()
+
+
+def jk_masks_w_map(mask, jk_map, froot, test=True, legacy=False):
+    '''Make jackknife masks with the jackknife regions in Healpix map.
+       The masks are saved in one file, or one file per mask if legacy.'''
+    jk_lab = utils.get_map_labels(jk_map)
+
+    if legacy:
+        njr = int(np.amax(jk_lab)) + 1 if len(jk_lab) > 0 else 0
+        write_jk_masks(mask, jk_lab, njr, froot, test=test)
+        return
+
+    save_jk_masks(mask, jk_lab, froot + '_jk_masks.fits')
+
+    if test:
+        import healpy as hp
+        import matplotlib.pyplot as plt
+        hp.mollview(np.where(jk_lab >= 0, 0., mask), coord='GC')
+        plt.show()
@@ -0,0 +1,125 @@
+'''
+Weighted, size balanced k-means regions on the sphere.
+An alternative to the RA strips x DEC pieces of kernel.knife, giving
+compact regions for irregular footprints.
+The regions are made by balanced bisecting k-means on unit vectors: each
+node is split in two by spherical 2-means, the cut across the two centers
+is put at the weighted quantile that gives each side the weight of its
+number of regions. The tree is fitted on a sub sample, then all the points
+are assigned in chunks.
+'''
+import numpy as np
+from . import kernel
+from . import coords
+from . import instrument
+
+
+def normalize(v):
+    '''Unit vectors along v (n, 3).'''
+    return v / np.linalg.norm(v, axis=1)[:, None]
+
+
+def two_means(x, w, niter=10):
+    '''Weighted spherical 2-means of unit vectors x, return the 2 centers.
+       Starts from the two ends of the principal axis.'''
+    mean = np.sum(w[:, None] * x, axis=0) / np.sum(w)
+    d = x - mean
+    cov = (w[:, None] * d).T @ d / np.sum(w)
+    val, vec = np.linalg.eigh(cov)
+    axis = vec[:, -1] * np.sqrt(val[-1])
+    centers = normalize(np.array([mean + axis, mean - axis]))
+
+    for _ in range(niter):
+        side = x @ (centers[0] - centers[1]) < 0.  # closer to center 1
+        for k, s in enumerate((~side, side)):
+            if np.any(s):
+                centers[k] = normalize(
+                    np.sum(w[s, None] * x[s], axis=0)[None, :])[0]
+
+    return centers
+
+
+def weighted_cut(proj, w, frac):
+    '''Threshold on proj leaving the fraction frac of the weight below.'''
+    order = np.argsort(proj)
+    cw = np.cumsum(w[order])
+    k = np.searchsorted(cw, frac * cw[-1])
+    k = min(max(k, 1), len(proj) - 1)
+
+    return 0.5 * (proj[order[k-1]] + proj[order[k]])
+
+
+def kmeans_fit(data, njr, nsub=1000000, niter=10, seed=0):
+    '''Fit balanced bisecting k-means to data [ra, dec, weight].
+       Return the tree: direction and threshold of the internal nodes,
+       children of the internal nodes and the labels of the leaves (-1 for
+       internal nodes). A point goes to the first child if x.dir < thr.'''
+    instrument.log('>> Fitting balanced k-means regions')
+    rng = np.random.default_rng(seed)
+    if len(data) > nsub:
+        sub = np.sort(rng.choice(len(data), size=nsub, replace=False))
+    else:
+        sub = np.arange(len(data))
+    x = coords.radec2vec(data[sub, 0], data[sub, 1], dtype=data.dtype).T
+    w = np.asarray(data[sub, 2], dtype=np.float64)
+
+    dirs, thrs, children, labels = [], [], [], []
+    nleaf = 0
+    stack = [(np.arange(len(x)), njr, None)]  # points, regions, parent
+    while stack:
+        pts, n, parent = stack.pop()
+        node = len(labels)
+        if parent is not None:
+            children[parent[0]][parent[1]] = node
+        dirs.append(np.zeros(3))
+        thrs.append(0.)
+        children.append([-1, -1])
+        if n == 1:  # leaf, labeled in depth first order
+            labels.append(nleaf)
+            nleaf += 1
+            continue
+        labels.append(-1)
+
+        centers = two_means(x[pts], w[pts], niter=niter)
+        dirs[node] = centers[1] - centers[0]
+        proj = x[pts] @ dirs[node]
+        n_1 = n // 2
+        thrs[node] = weighted_cut(proj, w[pts], n_1 / n)
+        first = proj < thrs[node]
+        # pushed second, popped first: first child gets the lower labels
+        stack.append((pts[~first], n - n_1, (node, 1)))
+        stack.append((pts[first], n_1, (node, 0)))
+
+    return np.array(dirs), np.array(thrs), np.array(children), \
+        np.array(labels)
+
+
+def kmeans_assign(data, tree, chunksize=1000000):
+    '''Labels of data [ra, dec, ...] with the fitted tree, in chunks.'''
+    dirs, thrs, children, labels = tree
+    jkl = np.empty(len(data), dtype=np.int64)
+    for i0 in range(0, len(data), chunksize):
+        s = slice(i0, i0 + chunksize)
+        x = coords.radec2vec(data[s, 0], data[s, 1], dtype=data.dtype).T
+        node = np.zeros(len(x), dtype=np.int64)
+        inner = labels[node] == -1
+        while np.any(inner):
+            nd = node[inner]
+            second = np.einsum('ij,ij->i', x[inner], dirs[nd]) >= thrs[nd]
+            node[inner] = children[nd, second.astype(np.int64)]
+            inner = labels[node] == -1
+        jkl[s] = labels[node]
+
+    return jkl
+
+
+def knife_kmeans(data, njr, **kwargs):
+    '''Knife function with balanced k-means, data [ra, dec, weight].
+       Return kernel.Regions, for kernel.make_jk_map.'''
+    tree = kmeans_fit(data, njr, **kwargs)
+    jkl = kmeans_assign(data, tree)
+
+    idx = np.argsort(jkl, kind='stable')
+    offsets = np.searchsorted(jkl[idx], np.arange(njr + 1))
+
+    return kernel.Regions(idx, offsets)
@@ -3,45 +3,333 @@ Make jackknife regions.
 '''
 from . import utils
 from . import kernel
+from . import catio
+from . import coords
+from . import kmeans
+from . import parallel
+from . import artifacts
+from . import instrument
 import numpy as np
-import healpy as hp
 
 
-def knife_rand(frand, njr, nra, rra, nside=None):
+def get_dtypes(single, njr):
+    '''Types of the randoms and of the full sky map, float64 for both or
+       float32 and integer labels in single precision mode.'''
+    if single:
+        return np.float32, utils.get_label_dtype(njr)
+    return np.float64, np.float64
+
+
+def load_rand(frand, dtype=np.float64, nproc=1, chunksize=10000000):
+    '''Randoms [ra, dec, weight]. For nproc > 1 they are read into shared
+       memory, attached by all the parallel stages without a copy, see
+       parallel.empty; binary files chunk by chunk, so the randoms are in
+       memory once.'''
+    if nproc == 1:
+        return catio.load_data(frand, tp='knife', dtype=dtype)
+    if catio.get_fmt(frand) == 'txt':
+        return parallel.to_shared(catio.load_data(frand, tp='knife',
+                                                  dtype=dtype))
+
+    rand = parallel.empty((catio.get_npts(frand), 3), dtype)
+    with instrument.span('load', npts=len(rand)):
+        i0 = 0
+        for chunk in catio.load_data_chunks(frand, chunksize, tp='knife',
+                                            dtype=dtype):
+            rand[i0:i0+len(chunk)] = chunk
+            i0 += len(chunk)
+
+    return rand
+
+
+def aggregate_rand(frand, nside, chunksize=10000000, dtype=np.float64):
+    '''Bin the randoms into weighted galactic Healpix pixels at nside.
+       The weights are kept for the covered pixels only, so the memory
+       scales with their number, not with the pixels of the sky.
+       Return the pixels and the table [ra, dec, weight] of their centers.'''
+    instrument.log('>> Aggregating randoms in pixels, nside = {0:d}'.format(
+        nside))
+    ipix, w_pix = np.zeros(0, dtype=np.int64), np.zeros(0)
+    npts = 0
+    for rand in catio.load_data_chunks(frand, chunksize, tp='knife',
+                                       dtype=dtype):
+        pix, inv = np.unique(coords.radec2pix(nside, rand[:, 0], rand[:, 1]),
+                             return_inverse=True)
+        w = np.bincount(inv, weights=rand[:, 2], minlength=len(pix))
+        # merge into the running table, old weights first as in a sum
+        ipix, inv = np.unique(np.concatenate((ipix, pix)), return_inverse=True)
+        w_pix = np.bincount(inv, weights=np.concatenate((w_pix, w)),
+                            minlength=len(ipix))
+        npts += len(rand)
+
+    keep = w_pix != 0.
+    ipix, w_pix = ipix[keep], w_pix[keep]
+    ra, dec = coords.pix2radec(nside, ipix)
+    table = np.column_stack((ra, dec, w_pix))
+    instrument.log('-- {0:d} randoms in {1:d} pixels'.format(npts, len(ipix)))
+
+    return ipix, table
+
+
+def agg_drift(frand, jk_agg, njr, chunksize=10000000, dtype=np.float64):
+    '''Weights of the regions made with aggregated randoms, summed over
+       the randoms themselves. Print and return the percent deviation from
+       the average weight, for the exact knife it is below one random.'''
+    w_jk = np.zeros(njr)
+    for rand in catio.load_data_chunks(frand, chunksize, tp='knife',
+                                       verbose=False, dtype=dtype):
+        ipix = coords.radec2pix(jk_agg.nside, rand[:, 0], rand[:, 1])
+        jkl = utils.lookup_sparse(jk_agg, ipix)
+        keep = jkl != -1
+        w_jk += np.bincount(jkl[keep], weights=rand[keep, 2], minlength=njr)
+
+    w_ave = np.sum(w_jk) / njr
+    pcdev = 100. * (w_jk - w_ave) / w_ave
+    instrument.log('-- Weight drift from aggregation, '
+                   'percent deviation from average:')
+    instrument.log('-- max: {0:f} %, rms: {1:f} %'.format(
+        np.amax(np.abs(pcdev)), np.sqrt(np.mean(pcdev**2))))
+
+    return pcdev
+
+
+def knife_rand(frand, njr, nra, rra, nside=None, sparse=False,
+               nside_agg=None, drift=True, nproc=1, cache=False,
+               single=False, return_labels=False):
     '''Make jackknife regions with randoms.
-       Columns: [RA, DEC, redshift, weight].'''
-    rand = utils.load_data_pd(frand, tp='knife')
+       Columns: [RA, DEC, redshift, weight].
+       If nside_agg is given, the randoms are first aggregated in pixels at
+       nside_agg and the pixel centers are knifed instead, nside_agg should
+       be well above nside. drift reports the region weights in this case.
+       nproc: number of processes for the DEC cuts, bounds and map, the
+       randoms are put in shared memory once for all of them;
+       cache: reuse the outputs for the same file content and parameters,
+       see artifacts;
+       single: precision mode, the randoms are read as float32 and the full
+       sky map has integer labels, -1 if not covered. The regions are the
+       same as in double precision for float32 source columns, see
+       kernel.knife for the conditions. Text values are parsed exactly in
+       float32 only, in double precision they can differ in the last digit;
+       return_labels: also return the labels of the randoms in file order,
+       -1 if not in any region, last; cached only if asked for. Not with
+       nside_agg.
+       Return the bounds, and the map if nside is given.'''
+    if return_labels and nside_agg is not None:
+        raise ValueError('No labels of the randoms with nside_agg')
+    dtype, map_dtype = get_dtypes(single, njr)
+    if cache:
+        key, meta = artifacts.get_key('knife_rand', frand, njr=njr, nra=nra,
+                                      rra=rra, nside=nside, sparse=sparse,
+                                      nside_agg=nside_agg, single=single)
+        res = artifacts.load(key)
+        if res is not None and return_labels and 'labels' not in res:
+            artifacts.invalidate(key=key)  # made again with the labels
+        elif res is not None:
+            return rand_outputs(res['bounds'], artifacts.unpack_map(res),
+                                res.get('labels'), nside, return_labels)
+
+    if nside_agg is None:
+        rand = load_rand(frand, dtype=dtype, nproc=nproc)
+    else:
+        ipix, rand = aggregate_rand(frand, nside_agg, dtype=dtype)
+        rand = parallel.to_shared(rand) if nproc > 1 else rand
+
+    regions = kernel.knife(rand, njr, nra, rra, nproc=nproc)
+
+    if nside_agg is not None and drift:
+        jkl = kernel.get_labels(regions, len(ipix))
+        agg_drift(frand, utils.SparseMap(nside_agg, ipix, jkl),
+                  len(regions.offsets) - 1, dtype=dtype)
+
+    jk_bounds = kernel.make_jk_bounds(rand, regions, rra, nproc=nproc)
+
+    jk_map = None
+    if nside is not None:
+        jk_map = kernel.make_jk_map(rand, regions, nside, sparse=sparse,
+                                    nproc=nproc, dtype=map_dtype)
+
+    jkl = kernel.get_labels(regions, len(rand)) if return_labels else None
+
+    if cache:
+        arrays = {'bounds': jk_bounds, 'labels': jkl}
+        if jk_map is not None:
+            arrays.update(artifacts.pack_map(jk_map))
+        artifacts.store(key, meta, arrays)
+
+    return rand_outputs(jk_bounds, jk_map, jkl, nside, return_labels)
+
 
-    d_dec = kernel.knife(rand, njr, nra, rra)
+def rand_outputs(jk_bounds, jk_map, jkl, nside, return_labels):
+    '''Outputs of knife_rand: bounds, map if nside is given, labels if
+       return_labels.'''
+    res = (jk_bounds,) + ((jk_map,) if nside is not None else ()) + \
+        ((jkl,) if return_labels else ())
 
-    jk_bounds = kernel.make_jk_bounds(d_dec)
+    return res[0] if len(res) == 1 else res
 
+
+def ra_hist(frand, rra, nbins, chunksize=10000000, dtype=np.float64):
+    '''Weights and numbers of the randoms in nbins bins of RA rotated by
+       rra, see kernel.get_ra_bins.'''
+    w_hist = np.zeros(nbins)
+    n_hist = np.zeros(nbins, dtype=np.int64)
+    for rand in catio.load_data_chunks(frand, chunksize, tp='knife',
+                                       dtype=dtype):
+        ibin = kernel.get_ra_bins(rand[:, 0], rra, nbins)
+        w_hist += np.bincount(ibin, weights=rand[:, 2], minlength=nbins)
+        n_hist += np.bincount(ibin, minlength=nbins)
+
+    return w_hist, n_hist
+
+
+def group_strips(n_strip, max_pts):
+    '''Consecutive RA strips in groups of at most max_pts points, a larger
+       strip is a group by itself. Return the edges of the groups.'''
+    groups = [0]
+    n = 0
+    for i, m in enumerate(n_strip):
+        if n > 0 and n + m > max_pts:
+            groups.append(i)
+            n = 0
+        n += m
+    groups.append(len(n_strip))
+
+    return groups
+
+
+def load_strips(frand, rra, nbins, b0, b1, chunksize=10000000,
+                dtype=np.float64):
+    '''Randoms [ra, dec, weight] in the rotated RA bins [b0, b1).
+       Return the randoms and their bins.'''
+    data, bins = [np.zeros((0, 3), dtype=dtype)], [np.zeros(0, dtype=np.int64)]
+    for rand in catio.load_data_chunks(frand, chunksize, tp='knife',
+                                       verbose=False, dtype=dtype):
+        ibin = kernel.get_ra_bins(rand[:, 0], rra, nbins)
+        keep = (ibin >= b0) & (ibin < b1)
+        data.append(rand[keep])
+        bins.append(ibin[keep])
+
+    return np.concatenate(data), np.concatenate(bins)
+
+
+def knife_rand_stream(frand, njr, nra, rra, nside=None, sparse=False,
+                      chunksize=10000000, nbins=1296000, max_pts=50000000,
+                      single=False):
+    '''Make jackknife regions with randoms too large for the memory.
+       Columns: [RA, DEC, redshift, weight].
+       Pass one streams the randoms into a weight histogram of rotated RA
+       with nbins bins (1 arcsec by default), the RA strips are cut at the
+       bin edges. Pass two reads the strips in groups of about max_pts
+       randoms, one pass over the file per group, and cuts them in DEC
+       exactly as kernel.knife. Memory: the group, or the largest strip if
+       larger, plus one chunk.
+       Tolerance: the weight of a strip is off by at most one RA bin at
+       each edge, the last region of the strip takes it, so every region
+       weight is within 2 * (max RA bin weight) + (max random weight) of
+       the average, printed at the end.
+       single: precision mode, see knife_rand.'''
+    dtype, map_dtype = get_dtypes(single, njr)
+    instrument.log('>> Knifing randoms in two passes: {}'.format(frand))
+    with instrument.span('ra_hist') as sp:
+        w_hist, n_hist = ra_hist(frand, rra, nbins, chunksize=chunksize,
+                                 dtype=dtype)
+        sp['npts'] = np.sum(n_hist)
+    w_total = np.sum(w_hist)
+    w_dec = w_total / njr
+    w_ra, n_dec = kernel.get_piece_weights(w_total, njr, nra)
+    edges = kernel.cut_hist(w_hist, w_ra[:-1])
+
+    cn = np.concatenate(([0], np.cumsum(n_hist)))
+    groups = group_strips(cn[edges[1:]] - cn[edges[:-1]], max_pts)
+    instrument.log('-- {0:d} RA strips in {1:d} groups'.format(
+        len(w_ra), len(groups) - 1))
+
+    jk_bounds, ipix, jkl, w_jk = [], [], [], []
+    for g0, g1 in zip(groups[:-1], groups[1:]):
+        data, bins = load_strips(frand, rra, nbins, edges[g0], edges[g1],
+                                 chunksize=chunksize, dtype=dtype)
+        with instrument.span('sort', npts=len(data)):
+            idx = np.argsort(bins, kind='stable')  # by strip
+        offsets_ra = np.searchsorted(bins[idx], edges[g0:g1+1])
+        regions = kernel.Regions(*kernel.cut_in_dec(
+            data, idx, offsets_ra, w_dec, n_dec[g0:g1]))
+
+        njr_done = sum(len(w) for w in w_jk)
+        cw = np.concatenate(([0.], np.cumsum(
+            data[regions.idx[:regions.offsets[-1]], 2], dtype=np.float64)))
+        w_jk.append(cw[regions.offsets[1:]] - cw[regions.offsets[:-1]])
+        jk_bounds.append(kernel.make_jk_bounds(data, regions, rra))
+        if nside is not None:
+            jk_map = kernel.make_jk_map(data, regions, nside, sparse=True)
+            ipix.append(jk_map.ipix)
+            jkl.append(jk_map.jkl.astype(np.int64) + njr_done)
+        del data, bins, idx, regions
+
+    w_jk = np.concatenate(w_jk)
+    w_ave = w_total / njr
+    instrument.log('-- {0:d} regions, max weight deviation from average: '
+                   '{1:f} %, two RA bins: {2:f} %'.format(
+                       len(w_jk), 100. * np.amax(np.abs(w_jk / w_ave - 1.)),
+                       100. * 2. * np.amax(w_hist) / w_ave))
+
+    jk_bounds = np.concatenate(jk_bounds)
     if nside is None:
         return jk_bounds
-    else:
-        jk_map = kernel.make_jk_map(d_dec, nside)
-        return jk_bounds, jk_map
 
+    jk_map = utils.make_sparse_map(nside, np.concatenate(ipix),
+                                   np.concatenate(jkl))
+    return jk_bounds, jk_map if sparse else utils.dense_jk_map(
+        jk_map, dtype=map_dtype)
+
+
+def knife_rand_kmeans(frand, njr, nside, sparse=False, **kwargs):
+    '''Make jackknife regions with randoms by balanced k-means, see kmeans.
+       The regions are not rectangles in RA, DEC, so only the Healpix map
+       is made. Columns: [RA, DEC, redshift, weight].'''
+    rand = catio.load_data(frand, tp='knife')
 
-def knife_mask(fmask, njr, nra, rra, nside):
+    regions = kmeans.knife_kmeans(rand, njr, **kwargs)
+
+    return kernel.make_jk_map(rand, regions, nside, sparse=sparse)
+
+
+def knife_mask(fmask, njr, nra, rra, nside, sparse=False, nproc=1,
+               cache=False, single=False):
     '''Make jackknife regions with mask.
-       Value on each pixel should be in range [0, 1] or hp.UNSEEN+(0,1].'''
-    print('>> Loading mask: {}'.format(fmask))
-    mask = hp.read_map(fmask)
-    nside = hp.get_nside(mask)
-    npix = hp.nside2npix(nside)
-    ipix = np.array([i for i in range(npix)])
+       Value on each pixel should be in range [0, 1] or hp.UNSEEN+(0,1].
+       nproc: number of processes for the DEC cuts;
+       cache: reuse the map for the same mask content and parameters;
+       single: full sky map of integer labels, -1 if not covered. The pixel
+       centers are kept in double precision, the regions are the same.'''
+    import healpy as hp
+    map_dtype = get_dtypes(single, njr)[1]
+    if cache:
+        key, meta = artifacts.get_key('knife_mask', fmask, njr=njr, nra=nra,
+                                      rra=rra, sparse=sparse, single=single)
+        res = artifacts.load(key)
+        if res is not None:
+            return artifacts.unpack_map(res)
+
+    instrument.log('>> Loading mask: {}'.format(fmask))
+    with instrument.span('load') as sp:
+        mask = hp.read_map(fmask)
+        sp['npts'] = len(mask)
+    nside = utils.npix2nside(len(mask))
 
     # cut off the pixels with value 0 or UNSEEN
-    idx = np.where((mask != 0.) & (mask != hp.UNSEEN))
-    mask, ipix = mask[idx], ipix[idx]
+    ipix = np.flatnonzero((mask != 0.) & (mask != utils.UNSEEN))
+
+    # RA, DEC of the pixels covered only
+    radec = coords.get_pix_radec(nside, ipix)
+    data = np.column_stack((radec[0], radec[1], mask[ipix]))
 
-    theta, phi = hp.pix2ang(nside, ipix)
-    ra, dec = utils.get_ra_dec(theta, phi)
-    data = np.column_stack((ra, dec, mask))
+    regions = kernel.knife(data, njr, nra, rra, nproc=nproc)
 
-    d_dec = kernel.knife(data, njr, nra, rra)
+    # the pixels are known, no need to go back from RA, DEC
+    jk_map = kernel.make_jk_map_w_pix(ipix, regions, nside, sparse=sparse,
+                                      dtype=map_dtype)
 
-    jk_map = kernel.make_jk_map(d_dec, nside)
+    if cache:
+        artifacts.store(key, meta, artifacts.pack_map(jk_map))
 
     return jk_map
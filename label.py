@@ -2,45 +2,77 @@
 Label points with jackknife regions.
 '''
 from . import utils
+from . import catio
+from . import coords
+from . import parallel
+from . import instrument
 import numpy as np
-import healpy as hp
+
+
+HEADER = 'RA   DEC   redshift   weight   jackknife'
+FMT = '% .15e   % .15e   % .15e   % .15e   %8d'
+
+
+def print_jkl_info(n_tot, n_lost, me=None):
+    '''Print the numbers of total and lost points.'''
+    if me is not None:
+        instrument.log('-- Label info, method: {}'.format(me))
+    instrument.log('-- # total points: {0:d}'.format(n_tot))
+    instrument.log('-- # points not covered in jk regions: {0:d}'.format(
+        n_lost))
+    instrument.log('-- percent: {0:f} %'.format(100. * n_lost / n_tot))
 
 
 def cat_jkl(jkl, me=None):
     '''Have a look at the jackknife labels.'''
     n_tot = len(jkl)
     n_lost = np.count_nonzero(jkl == -1)
-    if me is not None:
-        print('-- Label info, method: {}'.format(me))
-    print('-- # total points: {0:d}'.format(n_tot))
-    print('-- # points not covered in jk regions: {0:d}'.format(n_lost))
-    print('-- percent: {0:f} %'.format(100. * n_lost / n_tot))
+    print_jkl_info(n_tot, n_lost, me=me)
 
     return n_lost
 
 
+def shift_jkl(jkl, jk0):
+    '''Labels starting from jk0, the lost points kept at -1.'''
+    if jk0 == 0:
+        return jkl
+    return np.where(jkl != -1, jkl.astype(np.int32) + jk0, -1)
+
+
 def rm_lost_points(data):
     '''Remove the points not covered in jackknife regions.'''
     return data[data[:, -1] != -1]
 
 
 def save_labeled_data(data, fn):
-    '''Save the output data with jk label.'''
-    header = 'RA   DEC   redshift   weight   jackknife'
-    fmt = '% .15e   % .15e   % .15e   % .15e   %8d'
-    np.savetxt(fn, data, fmt=fmt, header=header)
-    print(':: Data written to file: {}'.format(fn))
+    '''Save the output data with jk label, text or binary by extension.'''
+    if catio.get_fmt(fn) != 'txt':
+        catio.save_data(data, fn)
+        return
+    with instrument.span('save', npts=len(data)):
+        np.savetxt(fn, data, fmt=FMT, header=HEADER)
+    instrument.log(':: Data written to file: {}'.format(fn))
 
 
-def label_w_map(data, jkr):
-    '''Label data points with jackknife regions given in Healpix map.'''
-    theta_gal, phi_gal = utils.get_theta_phi(data[:, 0], data[:, 1])
+def get_jkl_w_map(data, jkr):
+    '''Jackknife labels of data points given in Healpix map, -1 if lost.
+       jkr can be full sky map or utils.SparseMap.'''
+    if isinstance(jkr, utils.SparseMap):
+        ipix = coords.radec2pix(jkr.nside, data[:, 0], data[:, 1])
+        return utils.lookup_sparse(jkr, ipix)
+
+    nside = utils.npix2nside(len(jkr))
+    # pixel number for each point
+    ipix = coords.radec2pix(nside, data[:, 0], data[:, 1])
+
+    # label the points not covered with -1
+    return utils.get_map_labels(jkr)[ipix]
 
-    nside = hp.npix2nside(len(jkr))
-    ipix = hp.ang2pix(nside, theta_gal, phi_gal)  # pixel number for each point
 
-    jkl = jkr[ipix]
-    np.where(jkl != hp.UNSEEN, jkl, -1)  # label the points not covered with -1
+def label_w_map(data, jkr):
+    '''Label data points with jackknife regions given in Healpix map.'''
+    with instrument.span('label', npts=len(data)):
+        jkl = get_jkl_w_map(data, jkr)
 
     n_lost = cat_jkl(jkl, me='map')
 
@@ -49,7 +81,7 @@ def label_w_map(data, jkr):
 
     # get rid of lost points
     if n_lost > 0:
-        print('>> Removing points not covered in jackknife regions')
+        instrument.log('>> Removing points not covered in jackknife regions')
         data = rm_lost_points(data)
 
     return data
@@ -57,18 +89,9 @@ def label_w_map(data, jkr):
 
 def label_w_bounds(data, jkr):
     '''Label data points with jackknife regions given in bounds.'''
-    jkl = np.zeros(len(data[:, 0])) - 1
-    for i, p in enumerate(data):
-        for j, r in enumerate(jkr):
-            if p[1] >= r[2] and p[1] <= r[3]:  # DEC
-                if r[0] < r[1]:
-                    if p[0] >= r[0] and p[0] <= r[1]:
-                        jkl[i] = j
-                        break
-                else:  # regions crossing zero
-                    if p[0] >= r[0] or p[0] <= r[1]:
-                        jkl[i] = j
-                        break
+    with instrument.span('label', npts=len(data)):
+        index = utils.make_bounds_index(jkr)
+        jkl = utils.lookup_bounds(index, data[:, 0], data[:, 1])
 
     n_lost = cat_jkl(jkl, me='bounds')
 
@@ -77,7 +100,155 @@ def label_w_bounds(data, jkr):
 
     # get rid of lost points
     if n_lost > 0:
-        print('>> Removing points not covered in jackknife regions')
+        instrument.log('>> Removing points not covered in jackknife regions')
         data = rm_lost_points(data)
 
     return data
+
+
+def get_labeler(jkr, tp):
+    '''Function giving the labels of data [ra, dec, ...], -1 if lost.
+       jkr: Healpix map or utils.SparseMap if tp is 'map', bounds or their
+       index from utils.make_bounds_index if tp is 'bounds'.'''
+    if tp == 'map':
+        if not isinstance(jkr, utils.SparseMap):
+            jkr = utils.get_map_labels(jkr)  # converted once
+
+        def get_jkl(data):
+            return get_jkl_w_map(data, jkr)
+    elif tp == 'bounds':
+        index = jkr if isinstance(jkr, tuple) else utils.make_bounds_index(jkr)
+
+        def get_jkl(data):
+            return utils.lookup_bounds(index, data[:, 0], data[:, 1])
+    else:
+        raise ValueError('Wrong tp: {}'.format(tp))
+
+    return get_jkl
+
+
+def label_file(fn, jkr, fo=None, tp='bounds', chunksize=1000000,
+               verbose=True, dtype=np.float64, jk0=0):
+    '''Label the points in file fn chunk by chunk, so the memory used does
+       not depend on the size of the file. The points covered in jackknife
+       regions are written to text file fo, or if fo is None, the labels of
+       all the points are added to the binary file fn (-1 if lost).
+       The next chunk is read while the current one is labeled and written.
+       dtype: type of RA, DEC for the labeling, np.float32 gives the same
+       labels for float32 source columns, see catio.load_data. The columns
+       written to fo keep their precision.
+       jk0: first label, e.g. to merge the regions of several footprints,
+       the labels are [jk0, jk0+njr-1], -1 if lost.'''
+    get_jkl = get_labeler(jkr, tp)
+
+    if fo is None and catio.get_fmt(fn) == 'txt':
+        raise ValueError('Output file needed for text file: {}'.format(fn))
+
+    n_tot, n_lost = 0, 0
+    if fo is None:
+        with catio.jkl_column(fn) as col:
+            for data in catio.prefetch(catio.load_data_chunks(
+                    fn, chunksize, cols=[0, 1], verbose=verbose,
+                    dtype=dtype)):
+                with instrument.span('label', npts=len(data)):
+                    jkl = shift_jkl(get_jkl(data), jk0)
+                col[n_tot:n_tot+len(jkl)] = jkl
+                n_tot += len(jkl)
+                n_lost += int(np.count_nonzero(jkl == -1))
+    else:
+        with open(fo, 'w') as f:
+            for i, data in enumerate(catio.prefetch(catio.load_data_chunks(
+                    fn, chunksize, verbose=verbose))):
+                with instrument.span('label', npts=len(data)):
+                    jkl = shift_jkl(get_jkl(
+                        data[:, :2].astype(dtype, copy=False)), jk0)
+                n_tot += len(jkl)
+                n_lost += int(np.count_nonzero(jkl == -1))
+
+                data = rm_lost_points(np.column_stack((data, jkl)))
+                with instrument.span('save', npts=len(data)):
+                    np.savetxt(f, data, fmt=FMT,
+                               header=HEADER if i == 0 else '')
+        if verbose:
+            instrument.log(':: Data written to file: {}'.format(fo))
+
+    if verbose:
+        print_jkl_info(n_tot, n_lost, me=tp)
+
+    return n_tot, n_lost
+
+
+#--- Batch labeling ---#
+
+
+def share_regions(jkr, tp):
+    '''Arrays of the region definition for parallel.run, and the nside of
+       sparse maps.'''
+    if tp == 'bounds':
+        return utils.make_bounds_index(jkr)._asdict(), None
+    elif tp == 'map' and isinstance(jkr, utils.SparseMap):
+        return {'ipix': jkr.ipix, 'jkl': jkr.jkl}, jkr.nside
+    elif tp == 'map':
+        return {'jk_map': utils.get_map_labels(jkr)}, None
+    else:
+        raise ValueError('Wrong tp: {}'.format(tp))
+
+
+def get_shared_regions(tp, nside):
+    '''Region definition given to share_regions, from inside a task.'''
+    if tp == 'bounds':
+        return utils.BoundsIndex(*[parallel.get_array(k)
+                                   for k in utils.BoundsIndex._fields])
+    elif nside is not None:
+        return utils.SparseMap(nside, parallel.get_array('ipix'),
+                               parallel.get_array('jkl'))
+    else:
+        return parallel.get_array('jk_map')
+
+
+def label_task(task):
+    '''Label one file of the batch, see label_files.'''
+    fn, fo, tp, chunksize, nside, dtype, jk0 = task
+    jkr = get_shared_regions(tp, nside)
+
+    return label_file(fn, jkr, fo=fo, tp=tp, chunksize=chunksize,
+                      verbose=False, dtype=dtype, jk0=jk0)
+
+
+def label_files(fns, jkr, fos=None, tp='bounds', chunksize=1000000, nproc=1,
+                dtype=np.float64, jk0=0):
+    '''Label many files with the same jackknife regions, see label_file.
+       The region definition (bounds index or map) is made once and shared
+       with nproc worker processes, each labeling one file at a time.
+       fos: output files, None to add the labels to binary files;
+       dtype: type of the values read, jk0: first label, see label_file.
+       Return the numbers of total and lost points per file.'''
+    fos = [None] * len(fns) if fos is None else fos
+    if len(fos) != len(fns):
+        raise ValueError('Numbers of input and output files differ')
+    instrument.log('>> Labeling {0:d} files, method: {1}'.format(len(fns), tp))
+
+    arrays, nside = share_regions(jkr, tp)
+    tasks = [(fn, fo, tp, chunksize, nside, dtype, jk0)
+             for fn, fo in zip(fns, fos)]
+    res = parallel.run(label_task, tasks, arrays, nproc=nproc)
+
+    summary = np.array([(fn, n_tot, n_lost) for fn, (n_tot, n_lost)
+                        in zip(fns, res)],
+                       dtype=[('file', 'U{0:d}'.format(
+                           max([len(fn) for fn in fns] + [1]))),
+                              ('n_tot', 'i8'), ('n_lost', 'i8')])
+    print_batch_info(summary)
+
+    return summary
+
+
+def print_batch_info(summary):
+    '''Print the numbers of total and lost points of the labeled files.'''
+    instrument.log('-- Label info per file: '
+                   '# total points, # lost points, percent')
+    for fn, n_tot, n_lost in summary:
+        instrument.log('-- {0}: {1:d} {2:d} {3:f} %'.format(
+            fn, n_tot, n_lost, 100. * n_lost / max(n_tot, 1)))
+    print_jkl_info(int(np.sum(summary['n_tot'])),
+                   int(np.sum(summary['n_lost'])), me='all files')
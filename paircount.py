@@ -0,0 +1,137 @@
+'''
+Pair counts resolved in jackknife region pairs.
+Counts T[i, j, k] of pairs with the first point in region i, the second
+in region j and the separation in bin k are made in one pass, all the
+leave-one-out counts (DD, DR, RR) then follow from T.
+Needs scipy for the KD-trees.
+'''
+import numpy as np
+from . import parallel
+
+
+_trees = {}  # KD-trees of the regions, built once per process
+
+
+def radec2xyz(ra, dec, r=None):
+    '''Positions (n, 3) from RA, DEC [degree], on the unit sphere or at
+       distance r, e.g. the comoving distance of the redshift.'''
+    ra, dec = np.deg2rad(ra), np.deg2rad(dec)
+    xyz = np.column_stack((np.cos(dec)*np.cos(ra), np.cos(dec)*np.sin(ra),
+                           np.sin(dec)))
+    if r is not None:
+        xyz *= np.asarray(r)[:, None]
+
+    return xyz
+
+
+def theta2chord(theta):
+    '''Chord length on the unit sphere of angle theta [degree].'''
+    return 2. * np.sin(np.deg2rad(theta) / 2.)
+
+
+def sort_regions(pos, jkl, weights, njr):
+    '''Sort the points by region, the lost points (-1) are removed.
+       Return positions, weights and offsets of the regions.'''
+    jkl = np.asarray(jkl).astype(np.int64)
+    order = np.argsort(jkl, kind='stable')
+    order = order[jkl[order] != -1]
+    offsets = np.searchsorted(jkl[order], np.arange(njr + 1))
+    weights = np.ones(len(order)) if weights is None else \
+        np.asarray(weights, dtype=np.float64)[order]
+
+    return np.ascontiguousarray(pos[order]), weights, offsets
+
+
+def get_spheres(pos, offsets):
+    '''Centers and radii of spheres enclosing each region.'''
+    njr = len(offsets) - 1
+    centers, radii = np.zeros((njr, 3)), np.zeros(njr)
+    for i in range(njr):
+        p = pos[offsets[i]:offsets[i+1]]
+        if len(p) > 0:
+            centers[i] = np.mean(p, axis=0)
+            radii[i] = np.sqrt(np.amax(np.sum((p - centers[i])**2, axis=1)))
+
+    return centers, radii
+
+
+def get_tree(cat, i):
+    '''KD-tree of region i of catalog cat (1 or 2).'''
+    from scipy.spatial import cKDTree
+    if (cat, i) not in _trees:
+        pos = parallel.get_array('pos{0:d}'.format(cat))
+        offsets = parallel.get_array('offsets{0:d}'.format(cat))
+        _trees[(cat, i)] = cKDTree(pos[offsets[i]:offsets[i+1]])
+
+    return _trees[(cat, i)]
+
+
+def count_row(i):
+    '''Pair counts of region i of catalog 1 with all regions of catalog 2,
+       shape (njr, nbins).'''
+    bins = parallel.get_array('bins')
+    w1, w2 = parallel.get_array('w1'), parallel.get_array('w2')
+    off1, off2 = parallel.get_array('offsets1'), parallel.get_array('offsets2')
+    c1, r1 = parallel.get_array('centers1'), parallel.get_array('radii1')
+    c2, r2 = parallel.get_array('centers2'), parallel.get_array('radii2')
+
+    njr = len(off2) - 1
+    row = np.zeros((njr, len(bins) - 1))
+    if off1[i+1] == off1[i]:
+        return row
+
+    # regions further apart than the largest separation have no pairs
+    dist = np.sqrt(np.sum((c2 - c1[i])**2, axis=1))
+    near = np.flatnonzero((dist - r1[i] - r2 <= bins[-1]) &
+                          (off2[1:] > off2[:-1]))
+
+    tree = get_tree(1, i)
+    for j in near:
+        cnt = tree.count_neighbors(
+            get_tree(2, j), bins, cumulative=False,
+            weights=(w1[off1[i]:off1[i+1]], w2[off2[j]:off2[j+1]]))
+        row[j] = cnt[1:]  # cnt[0] is for separations <= bins[0]
+
+    return row
+
+
+def region_pair_counts(pos1, jkl1, bins, njr, weights1=None,
+                       pos2=None, jkl2=None, weights2=None, nproc=1):
+    '''Weighted pair counts resolved in region pairs, shape (njr, njr, nbins).
+       pos: positions (n, 3), see radec2xyz; for angular counts use unit
+       vectors and bins from theta2chord. Without the second catalog, the
+       auto counts are made, with each pair counted twice.
+       The rows of region pairs are counted over nproc processes.'''
+    auto = pos2 is None
+    pos1, w1, off1 = sort_regions(pos1, jkl1, weights1, njr)
+    if auto:
+        pos2, w2, off2 = pos1, w1, off1
+    else:
+        pos2, w2, off2 = sort_regions(pos2, jkl2, weights2, njr)
+    c1, r1 = get_spheres(pos1, off1)
+    c2, r2 = (c1, r1) if auto else get_spheres(pos2, off2)
+
+    arrays = {'bins': np.asarray(bins, dtype=np.float64),
+              'pos1': pos1, 'w1': w1, 'offsets1': off1,
+              'centers1': c1, 'radii1': r1,
+              'pos2': pos2, 'w2': w2, 'offsets2': off2,
+              'centers2': c2, 'radii2': r2}
+    _trees.clear()
+    try:
+        rows = parallel.run(count_row, range(njr), arrays, nproc=nproc)
+    finally:
+        _trees.clear()
+
+    return np.array(rows)
+
+
+def loo_pair_counts(counts):
+    '''Leave-one-out pair counts from region pair counts, shape (njr, nbins).
+       Pairs with either point in region k are left out for k. The
+       leave-one-out weight totals for the normalization can be made with
+       jkstat.loo_sums of jkstat.region_sums.'''
+    total = np.sum(counts, axis=(0, 1))
+    diag = counts[np.arange(len(counts)), np.arange(len(counts))]
+
+    return total - np.sum(counts, axis=1) - np.sum(counts, axis=0) + diag
+
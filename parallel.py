@@ -0,0 +1,114 @@
+'''
+Process pool with input arrays in shared memory.
+Arrays made with empty or to_shared are already in shared memory: run
+attaches them in the workers without a copy, e.g. the catalog given to
+the stages of a knife one after the other.
+'''
+import weakref
+import numpy as np
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+
+_arrays = {}  # arrays visible to the tasks, see get_array
+_shms = []  # shared memory attached in the worker process
+_owned = {}  # id of the arrays made by empty: their spec
+
+
+def share(arr):
+    '''Copy arr to shared memory. Return the shared memory and its spec.'''
+    arr = np.ascontiguousarray(arr)
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def empty(shape, dtype):
+    '''Array in new shared memory, freed with the array and its views.'''
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(
+        create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    arr = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _owned[id(arr)] = (shm.name, arr.shape, dtype.str)
+    weakref.finalize(arr, release, shm, id(arr))
+
+    return arr
+
+
+def to_shared(arr):
+    '''Copy of arr in shared memory, see empty, or arr if already there.'''
+    if id(arr) in _owned:
+        return arr
+    out = empty(arr.shape, arr.dtype)
+    out[...] = arr
+
+    return out
+
+
+def release(shm, key):
+    '''Free the shared memory of the array key made by empty.'''
+    _owned.pop(key, None)
+    shm.unlink()
+    try:
+        shm.close()
+    except BufferError:  # views still there at exit
+        pass
+
+
+def attach(spec):
+    '''Attach the array in shared memory given its spec.'''
+    shm = shared_memory.SharedMemory(name=spec[0])
+
+    return shm, np.ndarray(spec[1], dtype=np.dtype(spec[2]), buffer=shm.buf)
+
+
+def init_worker(specs):
+    '''Attach the shared arrays in a worker process.'''
+    _arrays.clear()
+    for key, spec in specs.items():
+        shm, _arrays[key] = attach(spec)
+        _shms.append(shm)
+
+
+def get_array(key):
+    '''Array key given to run, from inside a task.'''
+    return _arrays[key]
+
+
+def run(func, tasks, arrays, nproc=1, out=()):
+    '''Run func(task) for all the tasks over nproc processes.
+       The arrays (dict) are put in shared memory, unless made by empty,
+       and read in func with get_array. Arrays with keys in out may be
+       written by the tasks, on disjoint parts, and are copied back at the
+       end if they were copied.
+       Return the results in the order of the tasks.'''
+    if nproc == 1:  # no copy, no process
+        # keep the arrays of an outer run, e.g. a task calling kernel.knife
+        saved = {key: _arrays[key] for key in arrays if key in _arrays}
+        _arrays.update(arrays)
+        try:
+            return [func(task) for task in tasks]
+        finally:
+            for key in arrays:
+                _arrays.pop(key, None)
+            _arrays.update(saved)
+
+    shms, specs = {}, {}
+    try:
+        for key, arr in arrays.items():
+            if id(arr) in _owned:  # already in shared memory
+                specs[key] = _owned[id(arr)]
+            else:
+                shms[key], specs[key] = share(arr)
+        with mp.Pool(nproc, initializer=init_worker,
+                     initargs=(specs,)) as pool:
+            res = pool.map(func, tasks, chunksize=1)
+        for key in (k for k in out if k in shms):
+            arrays[key][...] = np.ndarray(specs[key][1], buffer=shms[key].buf,
+                                          dtype=np.dtype(specs[key][2]))
+        return res
+    finally:
+        for shm in shms.values():
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,69 @@
+'''
+Knife plan: the sorting work of kernel.knife kept for repeated calls.
+The plan of a catalog and rra has the rotated RA order, the weights and
+cumulative weights in that order, and the RA pieces already sorted along
+DEC. Knifing the same catalog with other njr or nra then costs the
+searches of the cuts and the sorts of the new RA pieces only, e.g. for a
+convergence check over njr. The regions are the same as kernel.knife.
+'''
+import numpy as np
+from . import kernel
+from . import instrument
+import collections
+
+
+# strips: RA pieces sorted along DEC, by range (i0, i1) of idx
+KnifePlan = collections.namedtuple('KnifePlan',
+                                   ['rra', 'w_total', 'idx', 'w', 'cw',
+                                    'strips'])
+
+
+def make_plan(data, rra):
+    '''Make the knife plan of data [ra, dec, weight] rotated by rra.'''
+    instrument.log('>> Making knife plan, rra = {0:f}'.format(rra))
+    idx = kernel.get_ra_rot(data[:, 0], rra).argsort()  # sort along RA
+    w = np.asarray(data[idx, 2], dtype=np.float64)
+
+    w_total = kernel.get_w_total(data[:, 2])
+
+    return KnifePlan(rra, w_total, idx, w, np.cumsum(w), {})
+
+
+def knife_w_plan(data, plan, njr, nra, nproc=1):
+    '''Knife function with the plan of data, see kernel.knife.
+       The new RA pieces sorted along DEC are added to the plan.'''
+    w_dec = plan.w_total / njr
+    w_ra, n_dec = kernel.get_piece_weights(plan.w_total, njr, nra)
+
+    if len(w_ra) == 1:  # only one RA piece
+        offsets_ra = np.array([0, len(plan.idx)])
+    else:
+        offsets_ra = kernel.cut_weights(plan.w, w_ra[:-1], cw=plan.cw)
+
+    idx, offsets = kernel.cut_in_dec(data, np.array(plan.idx), offsets_ra,
+                                     w_dec, n_dec, strips=plan.strips,
+                                     nproc=nproc)
+
+    return kernel.Regions(idx, offsets)
+
+
+def save_plan(plan, fn):
+    '''Save the plan to fn (.npz).'''
+    instrument.log('>> Saving knife plan: {}'.format(fn))
+    ranges = np.array(sorted(plan.strips), dtype=np.int64).reshape(-1, 2)
+    strips = np.concatenate([plan.strips[tuple(r)] for r in ranges] +
+                            [np.zeros(0, dtype=plan.idx.dtype)])
+    np.savez(fn, rra=plan.rra, w_total=plan.w_total, idx=plan.idx,
+             w=plan.w, cw=plan.cw, ranges=ranges, strips=strips)
+
+
+def load_plan(fn):
+    '''Load the plan saved by save_plan.'''
+    instrument.log('>> Loading knife plan: {}'.format(fn))
+    with np.load(fn) as f:
+        ranges, strips = f['ranges'], f['strips']
+        splits = np.split(strips, np.cumsum(ranges[:, 1] - ranges[:, 0])[:-1])
+        return KnifePlan(float(f['rra']), float(f['w_total']), f['idx'],
+                         f['w'], f['cw'],
+                         {(int(r[0]), int(r[1])): s
+                          for r, s in zip(ranges, splits)})
@@ -0,0 +1,15 @@
+'''
+Import time of the core modules, see bench.check_import_time.
+'''
+from .. import bench
+
+
+BUDGET = 0.5  # seconds
+
+
+def test_import_time():
+    '''The core modules import within the budget, without heavy modules.'''
+    t, heavy, ok = bench.check_import_time(budget=BUDGET)
+    assert heavy == []
+    assert t <= BUDGET
+    assert ok
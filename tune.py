@@ -0,0 +1,138 @@
+'''
+Tune nra and rra of kernel.knife for a footprint.
+The RA wrap point is put in the largest RA gap of the randoms, then a grid
+of nra and rotations is knifed in parallel, all from one RA order of the
+randoms: rotating RA only shifts the order cyclically.
+'''
+import numpy as np
+from . import kernel
+from . import parallel
+from . import instrument
+
+
+def find_rra(ra):
+    '''Rotation rra [degree] moving the middle of the largest RA gap to 0.
+       Return rra and the width of the gap.'''
+    ra_s = np.unique(ra)
+    gaps = np.append(np.diff(ra_s), ra_s[0] + 360. - ra_s[-1])  # last: wrap
+    k = np.argmax(gaps)
+    mid = (ra_s[k] + gaps[k] / 2.) % 360.
+
+    return (360. - mid) % 360., gaps[k]
+
+
+def get_rot_order(ra, order, rra):
+    '''Order along the RA rotated by rra, from the order along RA.'''
+    k = np.searchsorted(ra[order], 360. - rra, side='left')
+    return np.roll(order, -k)  # RA >= 360 - rra comes first after rotation
+
+
+def get_rot_grid(ra_s, rra, step, n=2):
+    '''Rotations rra + k * step, |k| <= n, giving different RA orders of
+       the sorted RA ra_s: moving the wrap point within a gap of the
+       randoms does not change the regions.'''
+    rras = (rra + step * np.arange(-n, n + 1)) % 360.
+    rras = rras[np.argsort(np.abs(np.arange(-n, n + 1)), kind='stable')]
+    k = np.searchsorted(ra_s, 360. - rras, side='left') % max(len(ra_s), 1)
+    _, first = np.unique(k, return_index=True)
+
+    return [float(r) for r in rras[np.sort(first)]]
+
+
+def score_regions(data, regions, rra, w_imb=10.):
+    '''Score of the regions, lower is better:
+       mean |ln(aspect ratio)| + w_imb * max fractional weight deviation.
+       Return the weight deviation, mean |ln(aspect ratio)| and the score.'''
+    idx, offsets = regions
+    njr = len(offsets) - 1
+    w_jk, aspect = np.zeros(njr), np.zeros(njr)
+    for i in range(njr):
+        sub = idx[offsets[i]:offsets[i+1]]
+        if len(sub) == 0:
+            aspect[i] = np.inf
+            continue
+        ra_rot = kernel.get_ra_rot(data[sub, 0], rra)
+        dec = data[sub, 1]
+        w_jk[i] = np.sum(data[sub, 2])
+        d_ra = (np.amax(ra_rot) - np.amin(ra_rot)) * \
+            np.cos(np.deg2rad(np.mean(dec)))
+        d_dec = np.amax(dec) - np.amin(dec)
+        aspect[i] = np.abs(np.log(max(d_ra, 1e-10) / max(d_dec, 1e-10)))
+
+    w_dev = np.amax(np.abs(w_jk / np.mean(w_jk) - 1.))
+    compact = np.mean(aspect)
+
+    return w_dev, compact, compact + w_imb * w_dev
+
+
+def get_layouts(njr, nras):
+    '''Drop the nra giving the same strips as a smaller one: if nra does
+       not divide njr, kernel.get_piece_weights makes nra - 1 strips of
+       njr // (nra - 1) regions plus one strip of the rest, if any, e.g.
+       for njr = 20 nra = 3 gives 2 strips and nra = 6 the same as nra = 5.
+       Return the nra kept and their number of strips.'''
+    kept, nstrips, seen = [], [], set()
+    for nra in sorted(set(int(n) for n in nras)):
+        _, n_dec = kernel.get_piece_weights(1., njr, nra)
+        layout = (len(n_dec), tuple(int(n) for n in n_dec))
+        if layout not in seen:
+            seen.add(layout)
+            kept.append(nra)
+            nstrips.append(len(n_dec))
+
+    return kept, nstrips
+
+
+def eval_candidate(task):
+    '''Knife and score one candidate (njr, nra, rra).'''
+    njr, nra, rra = task
+    data, order = parallel.get_array('data'), parallel.get_array('order')
+    idx = get_rot_order(data[:, 0], order, rra)
+    regions = kernel.knife(data, njr, nra, rra, idx=idx)
+
+    return score_regions(data, regions, rra)
+
+
+def tune_knife(data, njr, nras=None, rras=None, nproc=1):
+    '''Find nra and rra for kernel.knife of data [ra, dec, weight].
+       nras: candidate nra, by default from sqrt(njr)/2 to 2*sqrt(njr),
+       the ones giving the same strips as a smaller nra are dropped, see
+       get_layouts;
+       rras: candidate rotations, by default the one from find_rra and the
+       shifts of its wrap point by a quarter of the narrowest full sky RA
+       strip, up to two each way, that change the regions.
+       Return the best regions, nra, rra and the table of scores, with the
+       number of RA strips nstrip of each nra.'''
+    rra_gap, gap = find_rra(data[:, 0])
+    instrument.log('>> Largest RA gap: {0:f} degrees, rra = {1:f}'.format(
+        gap, rra_gap))
+    if nras is None:
+        nras = [n for n in range(1, njr + 1)
+                if njr / n**2 <= 4. and n**2 / njr <= 4.]
+    nras, nstrips = get_layouts(njr, nras)
+    order = np.argsort(data[:, 0])  # one sort for all the candidates
+    if rras is None:
+        rras = get_rot_grid(data[order, 0], rra_gap, 90. / max(nstrips))
+
+    tasks = [(njr, int(nra), float(rra)) for nra in nras for rra in rras]
+    nstrip = [n for n in nstrips for rra in rras]
+    instrument.log('>> Evaluating {0:d} candidate partitions'.format(
+        len(tasks)))
+    scores = parallel.run(eval_candidate, tasks,
+                          {'data': data, 'order': order}, nproc=nproc)
+
+    table = np.array([t[1:2] + (n,) + t[2:] + s
+                      for t, n, s in zip(tasks, nstrip, scores)],
+                     dtype=[('nra', 'i8'), ('nstrip', 'i8'), ('rra', 'f8'),
+                            ('w_dev', 'f8'), ('compact', 'f8'),
+                            ('score', 'f8')])
+    best = table[np.argmin(table['score'])]
+    nra, rra = int(best['nra']), float(best['rra'])
+    instrument.log('>> Best: nra = {0:d}, rra = {1:f}, '
+                   'weight deviation {2:f} %'.format(
+        nra, rra, 100. * best['w_dev']))
+
+    idx = get_rot_order(data[:, 0], order, rra)
+    regions = kernel.knife(data, njr, nra, rra, idx=idx)
+
+    return regions, nra, rra, table
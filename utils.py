@@ -1,20 +1,21 @@
 '''
 Some useful functions.
 '''
-import pandas as pd
 import numpy as np
-import healpy as hp
-import matplotlib.pyplot as plt
+import collections
+from . import coords
+from . import instrument
 
 
 #--- General ---#
 
 
-def load_data_pd(fn, tp='', verbose=True):
-    '''Load data file.'''
+def load_data_pd(fn, tp='', verbose=True, dtype=np.float64):
+    '''Load data file, values of type dtype.'''
+    import pandas as pd
     if verbose:
-        print('>> Loading data: {}'.format(fn))
-    df = pd.read_csv(fn, delim_whitespace=True, comment='#', header=None)
+        instrument.log('>> Loading data: {}'.format(fn))
+    df = pd.read_csv(fn, sep=r'\s+', comment='#', header=None, dtype=dtype)
     df = df.to_numpy()
     if tp == 'knife':
         # RA, DEC, weight
@@ -23,49 +24,178 @@ def load_data_pd(fn, tp='', verbose=True):
         return df
 
 
+def load_data_chunks(fn, chunksize, tp='', verbose=True, dtype=np.float64):
+    '''Load data file in chunks of chunksize rows, one chunk at a time.'''
+    import pandas as pd
+    if verbose:
+        instrument.log('>> Loading data in chunks of {0:d} rows: {1}'.format(
+            chunksize, fn))
+    reader = pd.read_csv(fn, sep=r'\s+', comment='#', header=None,
+                         chunksize=chunksize, dtype=dtype)
+    with reader:
+        for df in reader:
+            df = df.to_numpy()
+            if tp == 'knife':
+                # RA, DEC, weight
+                yield np.column_stack((df[:, 0], df[:, 1], df[:, 3]))
+            else:
+                yield df
+
+
 def get_ra_dec(theta, phi):
     '''Get RA, DEC [degree] from theta, phi [radians] used in Healpy.'''
-    rot = hp.Rotator(coord=['G', 'C'])
-    theta_equ, phi_equ = rot(theta, phi)
-    dec, ra = 90. - np.rad2deg(theta_equ), np.rad2deg(phi_equ)
-    # move RA in [-180,0) to [180,360)
-    ra = np.where(ra < 0., ra + 360., ra)
-
-    return ra, dec
+    return coords.thetaphi2radec(theta, phi)
 
 
 def get_theta_phi(ra, dec):
     '''Get theta, phi [radians] used in Healpy from RA, DEC [degree].'''
-    rot = hp.Rotator(coord=['C', 'G'])
-    theta_equ, phi_equ = np.deg2rad(90.-dec), np.deg2rad(ra)
-    theta_gal, phi_gal = rot(theta_equ, phi_equ)
-    # move phi in [-pi,0) to [pi,2pi)
-    phi_gal = np.where(phi_gal < 0., phi_gal + 2*np.pi, phi_gal)
-
-    return theta_gal, phi_gal
+    return coords.radec2thetaphi(ra, dec)
 
 
 #--- Map ---#
 
 
+UNSEEN = -1.6375e30  # hp.UNSEEN, without importing healpy
+
+
+def nside2npix(nside):
+    '''Number of Healpix pixels of nside.'''
+    return 12 * nside**2
+
+
+def npix2nside(npix):
+    '''Healpix nside of npix pixels.'''
+    return int(round(np.sqrt(npix / 12.)))
+
+
+# partial sky jackknife map: sorted covered pixels (ring) and their labels
+SparseMap = collections.namedtuple('SparseMap', ['nside', 'ipix', 'jkl'])
+
+
+def get_label_dtype(njr):
+    '''Smallest integer type for labels in [-1, njr).'''
+    return np.int16 if njr <= np.iinfo(np.int16).max else np.int32
+
+
+def get_map_fill(dtype):
+    '''Value of the pixels not covered in full sky map of type dtype:
+       UNSEEN for float maps, -1 for integer maps.'''
+    return -1 if np.issubdtype(dtype, np.integer) else UNSEEN
+
+
+def get_map_labels(jk_map):
+    '''Integer labels of full sky map, -1 for the pixels not covered.'''
+    if np.issubdtype(jk_map.dtype, np.integer):
+        return jk_map
+    jkl = np.where(jk_map != UNSEEN, jk_map, -1)
+
+    return jkl.astype(get_label_dtype(int(np.amax(jkl)) + 1))
+
+
+def make_sparse_map(nside, ipix, jkl):
+    '''Make sparse jackknife map from pixels and labels.
+       For repeated pixels, the last label wins as in a full sky map.'''
+    # reverse, so np.unique picks the last occurrence of each pixel
+    ipix, k = np.unique(ipix[::-1], return_index=True)
+    jkl = np.asarray(jkl)[::-1][k]
+    njr = int(np.amax(jkl)) + 1 if len(jkl) > 0 else 0
+
+    return SparseMap(nside, ipix, jkl.astype(get_label_dtype(njr)))
+
+
+def sparse_jk_map(jk_map):
+    '''Sparse jackknife map from full sky map.'''
+    jkl = get_map_labels(jk_map)
+    ipix = np.flatnonzero(jkl != -1)
+    return make_sparse_map(npix2nside(len(jk_map)), ipix, jkl[ipix])
+
+
+def dense_jk_map(jk_map, dtype=np.float64):
+    '''Full sky jackknife map of type dtype from sparse map.'''
+    dense = np.full(nside2npix(jk_map.nside), get_map_fill(dtype), dtype=dtype)
+    dense[jk_map.ipix] = jk_map.jkl
+
+    return dense
+
+
+def lookup_sparse(jk_map, ipix):
+    '''Labels of pixels ipix in sparse jackknife map, -1 if not covered.'''
+    if len(jk_map.ipix) == 0:
+        return np.full(len(ipix), -1, dtype=jk_map.jkl.dtype)
+    k = np.searchsorted(jk_map.ipix, ipix)
+    k = np.minimum(k, len(jk_map.ipix) - 1)
+
+    return np.where(jk_map.ipix[k] == ipix, jk_map.jkl[k], -1).astype(
+        jk_map.jkl.dtype)
+
+
 def save_jk_map(jk_map, fn):
-    '''Save jackknife map to fits file.'''
-    hp.write_map(fn, jk_map, overwrite=True)
-    print(':: Jackknife map saved to file: {}'.format(fn))
+    '''Save jackknife map to fits file, of the type of the map: integer
+       full sky map is saved as integer column, -1 if not covered.
+       Sparse map is saved as partial sky map, readable by hp.read_map.'''
+    import healpy as hp
+    if not isinstance(jk_map, SparseMap):
+        with instrument.span('save', npts=len(jk_map)):
+            hp.write_map(fn, jk_map, dtype=jk_map.dtype, overwrite=True)
+        instrument.log(':: Jackknife map saved to file: {}'.format(fn))
+        return
+
+    from astropy.io import fits
+    fmt = 'I' if jk_map.jkl.dtype == np.int16 else 'J'
+    cols = [fits.Column(name='PIXEL', format='K', array=jk_map.ipix),
+            fits.Column(name='JK', format=fmt, array=jk_map.jkl)]
+    hdu = fits.BinTableHDU.from_columns(cols)
+    hdu.header['PIXTYPE'] = ('HEALPIX', 'HEALPIX pixelisation')
+    hdu.header['ORDERING'] = ('RING', 'Pixel ordering scheme')
+    hdu.header['COORDSYS'] = ('G', 'Galactic coordinates')
+    hdu.header['NSIDE'] = (jk_map.nside, 'Resolution parameter of HEALPIX')
+    hdu.header['INDXSCHM'] = ('EXPLICIT', 'Indexing: IMPLICIT or EXPLICIT')
+    hdu.header['OBJECT'] = ('PARTIAL', 'Sky coverage: FULLSKY or PARTIAL')
+    with instrument.span('save', npts=len(jk_map.ipix)):
+        hdu.writeto(fn, overwrite=True)
+    instrument.log(':: Sparse jackknife map saved to file: {}'.format(fn))
+
+
+def load_jk_map(fn, sparse=False):
+    '''Load jackknife map, full sky or partial sky fits file.
+       Return sparse map if sparse, otherwise full sky map, integer if
+       saved as integer.'''
+    import healpy as hp
+    from astropy.io import fits
+    instrument.log('>> Loading jackknife map: {}'.format(fn))
+    with instrument.span('load'), fits.open(fn) as hdul:
+        header = hdul[1].header
+        if header.get('OBJECT', '').strip() == 'PARTIAL':
+            jk_map = make_sparse_map(header['NSIDE'],
+                                     np.asarray(hdul[1].data['PIXEL']),
+                                     np.asarray(hdul[1].data.field(1)))
+            return jk_map if sparse else dense_jk_map(jk_map)
+
+    with instrument.span('load') as sp:
+        jk_map = hp.read_map(fn, dtype=None)
+        jk_map = jk_map.astype(jk_map.dtype.newbyteorder('='), copy=False)
+        sp['npts'] = len(jk_map)
+    return sparse_jk_map(jk_map) if sparse else jk_map
 
 
 def plot_jk_map(jk_map, shuffle=False, njr=0, cmap=None):
     '''Plot jackknife map.'''
-    print(':: Plotting jackknife regions in Healpix map')
+    import healpy as hp
+    import matplotlib.pyplot as plt
+    instrument.log(':: Plotting jackknife regions in Healpix map')
+    if isinstance(jk_map, SparseMap):
+        jk_map = dense_jk_map(jk_map)
+    elif np.issubdtype(jk_map.dtype, np.integer):
+        jk_map = np.where(jk_map != -1, jk_map, UNSEEN)
     if shuffle:
-        print('-- shuffle the labels, looks better, demo only')
-        lb_max = np.int(np.amax(jk_map))
+        instrument.log('-- shuffle the labels, looks better, demo only')
+        lb_max = int(np.amax(jk_map))
         lb_min = lb_max - njr + 1
         arr = np.array([i for i in range(lb_min, lb_max+1, 1)])
         np.random.shuffle(arr)
         for i, p in enumerate(jk_map):
-            if p != hp.UNSEEN:
-                jk_map[i] = arr[np.int(p)-lb_min]
+            if p != UNSEEN:
+                jk_map[i] = arr[int(p)-lb_min]
     if cmap is None:
         hp.mollview(jk_map, coord='GC', title='jackknife regions')
     else:
@@ -74,18 +204,25 @@ def plot_jk_map(jk_map, shuffle=False, njr=0, cmap=None):
 
 
 def merge_jk_maps(maps, fo=None):
-    '''Merge jk maps each with label start from 0.'''
+    '''Merge jk maps each with label start from 0.
+       Integer maps give integer map, -1 if not covered.'''
     npix = len(maps[0])
-    map_tot = np.full(npix, hp.UNSEEN)
+    if np.issubdtype(maps[0].dtype, np.integer):
+        map_tot = np.full(npix, -1, dtype=np.int32)
+    else:
+        map_tot = np.full(npix, UNSEEN)
     njr = 0
     for i in range(len(maps)):
-        map_ = maps[i]
-        map_tot = np.where(map_ != hp.UNSEEN, map_ + njr, map_tot)
-        njr += np.amax(map_) + 1
+        jkl = get_map_labels(maps[i])
+        map_tot = np.where(jkl != -1, jkl + njr, map_tot).astype(
+            map_tot.dtype)
+        njr += int(np.amax(jkl)) + 1
 
     if fo is not None:
-        hp.write_map(fo, map_tot)
-        print('>> Merged jackknife map written to file: {}'.format(fo))
+        import healpy as hp
+        hp.write_map(fo, map_tot, dtype=map_tot.dtype)
+        instrument.log('>> Merged jackknife map written to file: {}'.format(
+            fo))
 
     return map_tot
 
@@ -97,8 +234,9 @@ def save_bounds(jk_bounds, fn):
     '''Save jackknife bounds to txt file.'''
     header = 'Number of jackknife regions: {0:d}\n'.format(len(jk_bounds))
     header += 'RA_min   RA_max   DEC_min   DEC_max'
-    np.savetxt(fn, jk_bounds, header=header)
-    print(':: Jackknife bounds saved to file: {}'.format(fn))
+    with instrument.span('save', npts=len(jk_bounds)):
+        np.savetxt(fn, jk_bounds, header=header)
+    instrument.log(':: Jackknife bounds saved to file: {}'.format(fn))
 
 
 def combine_bounds(bds):
@@ -111,6 +249,73 @@ def combine_bounds(bds):
     return data
 
 
+def get_cells(edges, x):
+    '''Cells of x given the sorted unique edges.
+       Cell 2k+1 is the edge k, cell 2k is between the edges k-1 and k.'''
+    k = np.searchsorted(edges, x, side='left')
+    on_edge = edges[np.minimum(k, len(edges) - 1)] == x
+
+    return 2 * k + on_edge
+
+
+# bounds index: RA, DEC edges and the runs of cells of each DEC band
+BoundsIndex = collections.namedtuple('BoundsIndex',
+                                     ['ra_e', 'dec_e', 'keys', 'labels'])
+
+
+def make_bounds_index(bds):
+    '''Make an index for bounds [ra_min, ra_max, dec_min, dec_max].
+       The RA and DEC edges of all the bounds cut the sky into cells, each
+       covered by the first region covering it, -1 if none. A DEC band of
+       cells is kept as its runs of RA cells of the same region: sorted
+       keys band * (number of RA cells) + first RA cell of the run, and
+       their labels. The memory scales with the regions met in the bands,
+       not with the number of cells, about (4 * njr)**2 for knife bounds.'''
+    ra_e, dec_e = np.unique(bds[:, :2]), np.unique(bds[:, 2:])
+    n_ra, n_dec = 2*len(ra_e) + 1, 2*len(dec_e) + 1
+    dtype = get_label_dtype(len(bds))
+
+    ia, ib = np.searchsorted(ra_e, bds[:, 0]), np.searchsorted(ra_e, bds[:, 1])
+    da, db = np.searchsorted(dec_e, bds[:, 2]), np.searchsorted(dec_e, bds[:, 3])
+
+    # regions meeting each band, in reversed order
+    nb = np.maximum(2*db - 2*da + 1, 0)
+    j = np.repeat(np.arange(len(bds)), nb)
+    band = np.repeat(2*da + 1 - np.cumsum(nb) + nb, nb) + np.arange(len(j))
+    order = np.lexsort((-j, band))
+    j, band = j[order], band[order]
+    starts = np.searchsorted(band, np.arange(n_dec + 1))
+
+    keys, labels = [], []
+    row = np.empty(n_ra, dtype=dtype)
+    for c in range(n_dec):
+        if starts[c] == starts[c+1]:  # no region in the band
+            keys.append([c * n_ra])
+            labels.append(np.array([-1], dtype=dtype))
+            continue
+        row[:] = -1
+        # fill in reversed order, so the first matching region wins
+        for k in j[starts[c]:starts[c+1]]:
+            if bds[k, 0] < bds[k, 1]:
+                row[2*ia[k]+1:2*ib[k]+2] = k
+            else:  # region crossing zero
+                row[2*ia[k]+1:] = k
+                row[:2*ib[k]+2] = k
+        r = np.concatenate(([0], np.flatnonzero(np.diff(row)) + 1))
+        keys.append(c * n_ra + r)
+        labels.append(row[r])
+
+    return BoundsIndex(ra_e, dec_e, np.concatenate(keys).astype(np.int64),
+                       np.concatenate(labels))
+
+
+def lookup_bounds(index, ra, dec):
+    '''Labels of the first bound covering (ra, dec), -1 if none.'''
+    ra_e, dec_e, keys, labels = index
+    cell = get_cells(dec_e, dec) * (2*len(ra_e) + 1) + get_cells(ra_e, ra)
+    return labels[np.searchsorted(keys, cell, side='right') - 1]
+
+
 def in_bound(ang, bd):
     '''Check if array ang(ra,dec) are in the bound.'''
     res = np.full(ang.shape[0], False, dtype=np.bool)